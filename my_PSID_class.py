@@ -1,51 +1,171 @@
 # -*- coding: utf-8 -*-
 
+import os
 import pandas as pd
 import re
 import numpy as np
-from tabulate import tabulate
-import matplotlib.pyplot as plt
+from pandas.api.types import union_categoricals
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from my_cache import data_cache
+from my_parallel import column_map
+from my_profiler import profile
 
 
 
+#default pattern for missing entries: NA, NAN, N/A and whitespaces (case insensitive)
+NA_REGEX = '^ *NAN? *$|^ *n/a *$'
+#numeric columns of the merged PSID data
+NUMERIC_LIST = ['family_income','mortgage_in_thousands','Number_of_People','Total_Family_Debt','Welfare_Receipt']
+#declared column types of the PSID extracts, used by the chunked loader
+PSID_SCHEMA = {'numeric':NUMERIC_LIST,
+               'category':['State','County','State_County'],
+               'id':['Year_Mortgage','Family_ID','SSN_deidentified','App_ID','Employer_ID','State_ID','County_Code']}
+#keys of the individual-family merge. The first one is the PSID wave, used to partition the merge
+MERGE_KEYS = ['Year_Mortgage','Family_ID','SSN_deidentified']
+#statistics of the aggregation cube, and number of cubes kept by each mortgage_pd
+CUBE_STATS = ['sum','count','mean','median']
+CUBE_CACHE_SIZE = 16
+
+
+"""
+tabulate.tabulate, imported on first use so that the data and QA core imports with pandas and NumPy only.
+Plotting (matplotlib) is also imported by the plotting methods themselves.
+"""
+def tabulate(*args,**kwargs):
+    from tabulate import tabulate as _tabulate
+    return _tabulate(*args,**kwargs)
+
+
 """
 Extend pd.DataFrame class.
 """
 class mortgage_pd(pd.DataFrame):
     
+    #cached aggregation cubes, see agg_cube. Class attribute so that pandas does not treat it as a column
+    _cube_cache = None
+    
     """
     Scans the data and set any string that match the regular expression pattern
     By default, it sets as empty string cells that contains only NA, NAN, N/A, and whitespces (case insensitive)
+    Only object/string columns are scanned and numeric columns keep their data types. The pattern is
+    matched against the distinct values of each column only, and matching cells are replaced column by column.
     IN:
         regex_string = '': user defined regular expression. Should begin with '|^' and end with '$'
+        inplace=False: modify self if True, otherwise return a new object sharing the untouched columns
     OUT:
-        mortgage_pd DataFrame type
+        mortgage_pd DataFrame type (None if inplace=True)
     """
-    def set_missing(self,regex_string = ''):
-        regex_str = '^ *NAN? *$|^ *n/a *$' + regex_string
-        na_pattern = re.compile(regex_str,re.I)
-        regex_na = lambda x: na_pattern.sub('',str(x))
-        return mortgage_pd(self.applymap(regex_na))
+    @profile
+    def set_missing(self,regex_string = '',inplace=False):
+        na_pattern = re.compile(NA_REGEX + regex_string,re.I)
+        out_data = self if inplace else mortgage_pd(self.copy(deep=False))
+        for i in out_data.select_dtypes(include=['object','string']).columns:
+            null_var = self.na_mask(out_data[i],na_pattern)
+            if null_var is not None:
+                out_data[i] = out_data[i].where(~null_var,'')
+        if not inplace:
+            return out_data
+        self.invalidate_cache()
         
     
+    """
+    Find the cells of a column that match the missing value pattern.
+    The regular expression is only evaluated once for each distinct value of the column.
+    IN:
+        series: object/string column of the data
+        na_pattern: compiled regular expression
+    OUT:
+        null_var: boolean pd.Series, True if the cell matches. None if no cell matches
+    """
+    @staticmethod
+    def na_mask(series,na_pattern):
+        na_values = [x for x in pd.unique(series.values) if na_pattern.search(str(x))]
+        if len(na_values) == 0:
+            return None
+        return series.isin(na_values)
+    
+    
     """
     Classify Mortgages based on income-to-loan ratio.
+    IN:
+        med=None: median of the ratio. Computed from the data if None (given when the data is one partition of a larger data)
     OUT:
         out_cat: pd.Series of categorical values    
     """
-    def set_category(self):
+    @profile
+    def set_category(self,med=None):
         inc_loan_ratio = self.mortgage_in_thousands/self.family_income
-        med = inc_loan_ratio.median()
+        if med == None:
+            med = inc_loan_ratio.median()
         null_input = inc_loan_ratio.isnull()
         flag_risky = (inc_loan_ratio<=med) & ~null_input
         flag_secure = (inc_loan_ratio>med) & ~null_input
-        out_cat = pd.Series(['' for i in range(len(inc_loan_ratio))])
-        out_cat[null_input] = 'NA'
-        out_cat[flag_risky] = 'Risky' 
-        out_cat[flag_secure] = 'Secure'
-        return out_cat
+        out_cat = np.select([null_input,flag_risky,flag_secure],['NA','Risky','Secure'],default='')
+        return pd.Series(pd.Categorical(out_cat,categories=['','NA','Risky','Secure']),index=self.index)
         
        
+    """
+    Reduce the memory of the data. Object columns with few distinct values are converted to categoricals,
+    integer columns (and float columns holding only whole numbers) are downcast to the smallest integer type
+    that holds their values. Float columns are downcast to float32 only if flag_float=True and no value changes.
+    IN:
+        var_list=None: list of strings. Columns to compact, all columns by default
+        max_category_ratio=0.5: convert object columns whose number of distinct values is at most this share of the rows
+        flag_float=False: allow float32 columns if True
+        print_flag=True: display the report if True
+    OUT:
+        report: pd.DataFrame with the data type and the memory in bytes of each column before and after, and the bytes saved
+    MODIFY:
+        Change data types of columns
+    """
+    @profile
+    def compact(self,var_list=None,max_category_ratio=0.5,flag_float=False,print_flag=True):
+        if var_list == None:
+            var_list = list(self.columns.values)
+        report_mat = []
+        for i in var_list:
+            col = self[i]
+            new_col = col
+            if isinstance(col.dtype,pd.CategoricalDtype) or pd.api.types.is_bool_dtype(col):
+                pass
+            elif pd.api.types.is_object_dtype(col) or pd.api.types.is_string_dtype(col):
+                if col.nunique(dropna=False) <= max_category_ratio*len(col):
+                    new_col = col.astype('category')
+            elif pd.api.types.is_integer_dtype(col):
+                new_col = pd.to_numeric(col,downcast='integer')
+            elif pd.api.types.is_float_dtype(col) and len(col)>0:
+                if col.notnull().all() and (col == np.floor(col)).all() and np.isfinite(col).all():
+                    new_col = pd.to_numeric(col.astype(np.int64),downcast='integer')
+                elif flag_float:
+                    col_32 = col.astype(np.float32)
+                    if ((col_32.astype(col.dtype) == col) | col.isnull()).all():
+                        new_col = col_32
+            before = col.memory_usage(index=False,deep=True)
+            after = new_col.memory_usage(index=False,deep=True)
+            if new_col is not col and after < before:
+                self[i] = new_col
+            else:
+                new_col,after = col,before
+            report_mat.append([i,str(col.dtype),str(new_col.dtype),before,after,before-after])
+        self.invalidate_cache()
+        report = pd.DataFrame(report_mat,columns=['Columns','Type','New Type','Bytes','New Bytes','Saved']).set_index('Columns')
+        if print_flag:
+            print(tabulate(report.reset_index(),headers='keys',showindex=False))
+            print('Total saved: {} bytes'.format(report['Saved'].sum()))
+        return report
+        
+    
+    """
+    Start a lazy pipeline over the data, see my_pipeline.mortgage_pipeline.
+    OUT:
+        mortgage_pipeline object
+    """
+    def lazy(self):
+        from my_pipeline import mortgage_pipeline
+        return mortgage_pipeline(self)
+        
+        
     """
     Convert columns specified by var_list to numeric.
     If columns contain non-numeric values, raise exception
@@ -54,9 +174,11 @@ class mortgage_pd(pd.DataFrame):
     MODIFY:
         Change data types of columns to numeric
     """
+    @profile
     def type_num(self,var_list=[]):
         for i in var_list:
             self[i] = pd.to_numeric(self[i])
+        self.invalidate_cache()
         
     
     """
@@ -66,7 +188,8 @@ class mortgage_pd(pd.DataFrame):
     OUT:
         flag: pd.Series that takes -1 if outlier, 1 if regular, np.nan if missing
     """
-    def MAD(self,series):
+    @staticmethod
+    def MAD(series):
         med = series.median()
         mad = abs(series-med).median()
         if mad>0.1:
@@ -79,80 +202,214 @@ class mortgage_pd(pd.DataFrame):
         flag[series.isnull()] = np.nan
         return flag
         
+    
+    """
+    Group-by-group version of MAD for several columns at once.
+    The medians, the median absolute deviations and the 99th percentile cutoffs of the scores are computed
+    for all groups and all columns in one grouped pass each, instead of calling MAD group by group.
+    IN:
+        var_list: list of strings. Must be numeric column names of the DataFrame object
+        category: list of strings. Must be column name of the DataFrame object
+    OUT:
+        flag: pd.DataFrame with columns var_list, takes -1 if outlier, 1 if regular, np.nan if missing
+              (or if the category is missing)
+    """
+    def group_MAD(self,var_list,category):
+        group_code = self.groupby(category,sort=False,observed=True).ngroup().to_numpy(dtype=float)
+        group_code[group_code<0] = np.nan #rows with missing category
+        return self.code_MAD(self[var_list],group_code)
+    
+    
+    """
+    Apply MAD to each group identified by integer group codes. Called by group_MAD.
+    IN:
+        group_data: pd.DataFrame of numeric columns
+        group_code: np.array of group codes aligned with the rows of group_data, np.nan for rows without group
+    OUT:
+        flag: pd.DataFrame, same as group_MAD
+    """
+    @staticmethod
+    def code_MAD(group_data,group_code):
+        med = group_data.groupby(group_code).transform('median')
+        dev = (group_data-med).abs()
+        mad = dev.groupby(group_code).transform('median')
+        flag_score = mad>0.1
+        score = (dev/mad).where(flag_score)
+        cut_off = score.groupby(group_code).transform('quantile',0.99)
+        cut_off_flag = (score>cut_off) | (~flag_score & (dev>1))
+        flag = pd.DataFrame(np.where(cut_off_flag,-1.0,1.0),index=group_data.index,columns=group_data.columns)
+        return flag.where(group_data.notnull() & med.notnull())
+        
+    
+    """
+    MAD (or code_MAD if group_code is given) on a numpy array. Job function of the parallel check_outlier.
+    IN:
+        values: np.array of a numeric column
+        group_code=None: np.array of group codes, see code_MAD
+    OUT:
+        flag: np.array that takes -1 if outlier, 1 if regular, np.nan if missing
+    """
+    @staticmethod
+    def array_MAD(values,group_code=None):
+        if group_code is None:
+            return mortgage_pd.MAD(pd.Series(values,dtype=float)).to_numpy(dtype=float)
+        return mortgage_pd.code_MAD(pd.DataFrame({'x':values}),group_code)['x'].to_numpy(dtype=float)
+        
       
     """
     Call MAD function. For each numeric column specifed in the var_list, check for outliers.
-    Allows for category-by-category check (e.g. find outliers for each county).
+    Allows for category-by-category check (e.g. find outliers for each county), see group_MAD.
     IN:
         var_list: list of strings. Must be column name of the DataFrame object
-        method='MAD': method to be used. Currently only support the method defined by the MAD function
+        method='MAD': method to be used. 'MAD' for the method defined by the MAD function, 'sketch' for the same rule with
+                      approximate quantiles from streaming sketches (see my_sketch.sketch_MAD), read chunk by chunk
         flag_add_col = False: add columns to the self object if True
         category = None: list of strings. Must be column name of the DataFrame object. Used for category-by-category check.
+        n_jobs = None: number of processes. If specified, columns are checked in parallel (see my_parallel.column_map)
+        eps = 0.001: normalized rank error of the sketches. Only used by method='sketch'
+        chunksize = 100000: number of rows per chunk. Only used by method='sketch'
+        seed = 0: seed of the random compactions of the sketches, so that the flags are the same from run to run.
+                  Only used by method='sketch'
     OUT:
         out_dict: dictionary. column names specificed in var_list with the associated row index of the outliers
     MODIFY:
         If flag_add_col = True, add columns to the self object for each column name specified in the var_list.
         Naming rule is variable names + '_' + method names (e.g. mortgage_in_thousands_MAD).
     """
-    def check_outlier(self,var_list,method='MAD',flag_add_col = False, category = None):
+    @profile
+    def check_outlier(self,var_list,method='MAD',flag_add_col = False, category = None, n_jobs = None, eps = 0.001, chunksize = 100000, seed = 0):
+        if method == 'MAD':
+            if n_jobs != None:
+                shared_list = []
+                if category != None:
+                    group_code = self.groupby(category,sort=False,observed=True).ngroup().to_numpy(dtype=float)
+                    group_code[group_code<0] = np.nan
+                    shared_list = [group_code]
+                array_dict = {i:self[i].to_numpy(dtype=float) for i in var_list}
+                flag_dict = column_map(self.array_MAD,array_dict,n_jobs,shared_list)
+                flag_data = pd.DataFrame(flag_dict,index=self.index,columns=var_list)
+            elif category == None:
+                flag_data = pd.DataFrame({i:self.MAD(self[i]) for i in var_list},index=self.index,columns=var_list)
+            else:
+                flag_data = self.group_MAD(var_list,category)
+        elif method == 'sketch':
+            from my_sketch import sketch_outlier
+            chunk_func = lambda: (self.iloc[i:i+chunksize] for i in range(0,len(self),chunksize))
+            flag_data = pd.concat(list(sketch_outlier(chunk_func,var_list,category,eps,seed)))
+            flag_data = flag_data.reindex(columns=var_list)
+        else:
+            raise NameError('Wrong Algorithm')
         out_dict = dict()
-        print_mat = []       
         for i in var_list:
-            if method == 'MAD':
-                if category == None:
-                    out_lier = self.MAD(self[i])
-                else:
-                    group_series = self.groupby(category)[i]
-                    group_func = lambda col: self.MAD(col)
-                    out_lier = group_series.transform(group_func)
-            else:
-                raise NameError('Wrong Algorithm')
             if flag_add_col:
-                self[i+'_'+method] = out_lier
-            out_dict[i+'_'+method] = self.index[out_lier==-1] 
-            print_mat.append([sum(out_lier==-1)/(sum(out_lier==1)+sum(out_lier==-1))*100])
+                self[i+'_'+method] = flag_data[i]
+                self.invalidate_cache()
+            out_dict[i+'_'+method] = self.index[(flag_data[i]==-1).values]
+        print_mat = ((flag_data==-1).sum()/flag_data.notnull().sum()*100).tolist()
         print(tabulate(zip(var_list,print_mat),headers = ['Columns','Outlier Percentage']))
         return out_dict
         
     
+    """
+    Compare the outliers found by method='sketch' with the exact ones of method='MAD' (see check_outlier).
+    IN:
+        var_list: list of strings. Must be numeric column names of the DataFrame object
+        category = None: list of strings. Used for category-by-category check
+        eps = 0.001: normalized rank error of the sketches
+        chunksize = 100000: number of rows per chunk of the sketches
+        seed = 0: seed of the random compactions of the sketches
+    OUT:
+        out_data: pd.DataFrame indexed by var_list with the numbers of exact and sketch outliers, of outliers found
+                  by both, only by the sketch (false positive) and only by the exact method (false negative),
+                  and the percentage of rows flagged the same way
+    """
+    @profile
+    def outlier_accuracy(self,var_list,category=None,eps=0.001,chunksize=100000,seed=0):
+        from my_sketch import sketch_outlier
+        if category == None:
+            exact_data = pd.DataFrame({i:self.MAD(self[i]) for i in var_list},index=self.index,columns=var_list)
+        else:
+            exact_data = self.group_MAD(var_list,category)
+        chunk_func = lambda: (self.iloc[i:i+chunksize] for i in range(0,len(self),chunksize))
+        sketch_data = pd.concat(list(sketch_outlier(chunk_func,var_list,category,eps,seed))).reindex(columns=var_list)
+        exact_flag = exact_data == -1
+        sketch_flag = sketch_data == -1
+        out_data = pd.DataFrame({'Exact':exact_flag.sum(),'Sketch':sketch_flag.sum(),
+                                 'Both':(exact_flag & sketch_flag).sum(),
+                                 'False Positive':(~exact_flag & sketch_flag).sum(),
+                                 'False Negative':(exact_flag & ~sketch_flag).sum(),
+                                 'Agreement':(exact_flag == sketch_flag).mean()*100},index=var_list)
+        out_data.index.name = 'Columns'
+        print(tabulate(out_data,headers='keys'))
+        return out_data
+
+
     """
     Check missingness of columns as specified by var_list. Display percentage of missing entries.
     IN:
         var_list: list of strings. Must be column name of the DataFrame object
+        n_jobs = None: number of processes. If specified, numeric columns are checked in parallel (see my_parallel.column_map).
+                       Other columns are checked in the current process
     OUT:
         out_dict: dictionary. column names specificed in var_list with the associated row index of missing values
     """
-    def check_missing(self,var_list):
+    @profile
+    def check_missing(self,var_list,n_jobs=None):
+        null_dict = dict()
+        if n_jobs != None:
+            array_dict = {i:self[i].to_numpy() for i in var_list if pd.api.types.is_numeric_dtype(self[i])}
+            null_dict = column_map(self.array_null,array_dict,n_jobs)
         out_dict = dict()
         print_mat = []
         for i in var_list:
-            null_var = self[i].isnull()
+            null_var = null_dict[i] if i in null_dict else self[i].isnull().values
             out_dict[i] = self.index[null_var]
-            print_mat.append([sum(null_var)/len(null_var)*100])
+            print_mat.append(null_var.sum()/len(null_var)*100)
         print(tabulate(zip(var_list,print_mat),headers = ['Columns','Missing Percentage']))
         return out_dict
         
+        
+    """
+    Missing entries of a numeric array. Job function of the parallel check_missing.
+    IN:
+        values: np.array of a numeric column
+    OUT:
+        np.array of booleans, True if missing
+    """
+    @staticmethod
+    def array_null(values):
+        if values.dtype.kind in 'fc':
+            return np.isnan(values)
+        return np.zeros(len(values),dtype=bool)
+        
      
     """
     Check whether the data is uniquely identified by the list of columns specified in var_list.
     Display Duplicated Percentage as percentage of duplicated rows in the data.
     Display Unique Duplicated Percentage as percentage of unique duplicated entries of all unique entries.
+    The identifier columns are hashed once into a key_index, which gives both statistics and the rows to drop.
     IN:
         var_list: list of strings. Must be column name of the DataFrame object
         keep_flag=True: if False, drops duplicates from self except for the first instance.
+        key_idx=None: key_index of self built beforehand (e.g. kept up to date while appending waves). var_list is then
+                      taken from key_idx. The index is updated if duplicates are dropped
     OUT:
         out_data: mortgage_pd Dataframe with duplicated rows.
     MODIFY:
         Drops duplicates from self except for the first instance if keep_flag=True
     """
-    def check_unique(self,var_list=None, keep_flag=True):
-        if var_list == None:
-            var_list = list(self.columns.values)
-        flag_duplicate = self.duplicated(subset=var_list,keep=False)
-        flag_unique_duplicate = self.duplicated(subset=var_list,keep='first')
-        total_unique = len(flag_duplicate)-sum(flag_unique_duplicate)
-        num_unique_duplicate = sum(flag_duplicate) - sum(flag_unique_duplicate)
-        print_mat = [sum(flag_duplicate)/len(flag_duplicate)*100,num_unique_duplicate/total_unique*100]
+    @profile
+    def check_unique(self,var_list=None, keep_flag=True, key_idx=None):
+        if key_idx == None:
+            if var_list == None:
+                var_list = list(self.columns.values)
+            key_idx = key_index(self,var_list)
+        elif len(key_idx) != len(self):
+            raise ValueError('key_index does not match the data')
+        var_list = key_idx.var_list
+        flag_duplicate = key_idx.flag_duplicate()
+        num_duplicate,total_unique,num_unique_duplicate = key_idx.count_duplicate()
+        print_mat = [num_duplicate/len(flag_duplicate)*100,num_unique_duplicate/total_unique*100]
         if len(var_list) == len(list(self.columns.values)):
             print_list = ['All Variables']
         else:
@@ -162,22 +419,218 @@ class mortgage_pd(pd.DataFrame):
         out_data = mortgage_pd(self[flag_duplicate].copy())
         if keep_flag==False:
             print(keep_flag)
-            self.drop_duplicates(subset = var_list,keep='first',inplace=True)
+            flag_unique_duplicate = key_idx.flag_unique_duplicate
+            if self.index.is_unique:
+                self.drop(self.index[flag_unique_duplicate],inplace=True)
+            else:
+                self.drop_duplicates(subset = var_list,keep='first',inplace=True)
+            key_idx.keep(~flag_unique_duplicate)
+            self.invalidate_cache()
         return out_data
     
 
     """
-    Display summary statistics of variables listed in var_list
+    Display summary statistics of variables listed in var_list, optionally group by group.
+    All statistics of all columns are computed together by block_stats on one 2-D numpy block.
     IN:
         var_list: list of strings. Must be column name of the DataFrame object
+        by=None: list of strings. Must be column name of the DataFrame object. Statistics are computed for each group if specified
+        quantile_list=(): extra quantiles to report (e.g. [0.25,0.75])
+        n_jobs = None: number of processes. If specified, columns are summarized in parallel (see my_parallel.column_map)
+        print_flag=True: display the table if True
+    OUT:
+        stats_data: pd.DataFrame of the statistics. Indexed by column names (and group values if by is specified)
     """
-    def sum_stats(self,var_list):
-        print_mat = []
-        for i in var_list:
-            print_mat.append([i,self[i].mean(),self[i].std(),self[i].median(),self[i].min(),self[i].max()])
-        print(tabulate(print_mat,headers = ['Columns','Mean','Std.','Median', 'Min','Max']))        
+    @profile
+    def sum_stats(self,var_list,by=None,quantile_list=(),n_jobs=None,print_flag=True):
+        if isinstance(by,str):
+            by = [by]
+        group_code = None
+        if by != None:
+            grouped = self.groupby(by,observed=True)
+            group_index = grouped.size().index
+            if n_jobs != None or len(quantile_list) > 0:
+                group_code = grouped.ngroup().to_numpy(dtype=float)
+                group_code[group_code<0] = np.nan
+        if n_jobs != None:
+            array_dict = {i:self[i].to_numpy(dtype=float) for i in var_list}
+            if group_code is None:
+                stats_dict = column_map(self.block_stats,array_dict,n_jobs,args=(None,tuple(quantile_list)))
+            else:
+                stats_dict = column_map(self.block_stats,array_dict,n_jobs,[group_code],(tuple(quantile_list),))
+            stats_mat = np.concatenate([stats_dict[i] for i in var_list],axis=2)
+        elif by != None:
+            block = self[var_list].to_numpy(dtype=float) if len(quantile_list) > 0 else None
+            stats_mat = self.group_stats(grouped[var_list],block,group_code,quantile_list)
+        else:
+            stats_mat = self.block_stats(self[var_list].to_numpy(dtype=float),None,quantile_list)
+        stats_list = ['Count','Mean','Std.','Median','Min','Max']+['Q{:g}%'.format(q*100) for q in quantile_list]
+        #(groups, statistics, columns) -> one row per group and column
+        stats_mat = stats_mat.transpose(0,2,1).reshape(-1,len(stats_list))
+        if by == None:
+            row_index = pd.Index(var_list,name='Columns')
+        else:
+            group_list = [g if isinstance(g,tuple) else (g,) for g in group_index]
+            row_index = pd.MultiIndex.from_tuples([g+(i,) for g in group_list for i in var_list],names=by+['Columns'])
+        stats_data = pd.DataFrame(stats_mat,index=row_index,columns=stats_list)
+        if print_flag:
+            print(tabulate(stats_data.reset_index(),headers='keys',showindex=False))
+        return stats_data
+
+
+    """
+    Summary statistics kernel. Without groups, each column is reduced on its own (no temporaries of the size of the
+    block): the median, the minimum, the maximum and the extra quantiles come from a single selection (np.partition)
+    on the non-missing values. With groups, see group_stats.
+    Quantiles use linear interpolation, as pd.Series.quantile. Missing values are skipped.
+    IN:
+        block: 2-D np.array of floats (rows, columns), or 1-D for a single column
+        group_code=None: np.array of group codes 0..k-1 aligned with the rows, np.nan for rows without group.
+                         All rows form one group if None
+        quantile_list=(): extra quantiles
+    OUT:
+        np.array of shape (groups, statistics, columns). Statistics are count, mean, std, median, min, max and the extra quantiles
+    """
+    @staticmethod
+    def block_stats(block,group_code=None,quantile_list=()):
+        if block.ndim == 1:
+            block = block.reshape(-1,1)
+        pos_list = [0.5]+list(quantile_list)
+        if group_code is not None:
+            num_group = int(np.nanmax(group_code))+1 if np.any(~np.isnan(group_code)) else 0
+            code = np.where(np.isnan(group_code),-1,group_code).astype(np.int64)
+            #categorical codes: the groups are used as they are, without being factorized again
+            grouped = pd.DataFrame(block).groupby(pd.Categorical.from_codes(code,categories=np.arange(num_group)),observed=False)
+            return mortgage_pd.group_stats(grouped,block,group_code,quantile_list)
+        out = np.full((1,6+len(quantile_list),block.shape[1]),np.nan)
+        for j in range(block.shape[1]):
+            values = block[:,j]
+            values = values[~np.isnan(values)]
+            out[0,0,j] = len(values)
+            if len(values) == 0:
+                continue
+            pos = np.array(pos_list)*(len(values)-1)
+            lo = np.floor(pos).astype(int)
+            hi = np.ceil(pos).astype(int)
+            part = np.partition(values,np.unique(np.r_[0,lo,hi,len(values)-1]))
+            quant = part[lo]+(part[hi]-part[lo])*(pos-lo)
+            out[0,1,j] = part.mean()
+            if len(values) > 1:
+                out[0,2,j] = part.std(ddof=1)
+            out[0,3,j] = quant[0]
+            out[0,4,j] = part[0]
+            out[0,5,j] = part[-1]
+            out[0,6:,j] = quant[1:]
+        return out
 
         
+    """
+    Grouped part of block_stats. The count, mean, standard deviation, median, minimum and maximum come from the cython
+    groupby reductions of pandas. Extra quantiles are selected (np.partition) group by group from each column ordered
+    by group once (stable radix sort of the group codes), since the grouped quantile of pandas is several times
+    slower than its median.
+    IN:
+        grouped: DataFrameGroupBy of the numeric columns, with groups in the order of the group codes
+        block=None: 2-D np.array of floats (rows, columns) of the same columns. Only needed for extra quantiles
+        group_code=None: np.array of group codes, see block_stats. Only needed for extra quantiles
+        quantile_list=(): extra quantiles
+    OUT:
+        np.array of shape (groups, statistics, columns), see block_stats
+    """
+    @staticmethod
+    def group_stats(grouped,block=None,group_code=None,quantile_list=()):
+        stats_list = [grouped.count(),grouped.mean(),grouped.std(),grouped.median(),grouped.min(),grouped.max()]
+        out = np.stack([stats.to_numpy(dtype=float) for stats in stats_list],axis=1)
+        if len(quantile_list) == 0:
+            return out
+        num_group = out.shape[0]
+        quant = np.full((num_group,len(quantile_list),block.shape[1]),np.nan)
+        in_group = ~np.isnan(group_code)
+        code = group_code[in_group].astype(np.int16 if num_group < 2**15 else np.int64)
+        order = np.flatnonzero(in_group)[np.argsort(code,kind='stable')]
+        end = np.cumsum(np.bincount(code,minlength=num_group))
+        start = np.r_[0,end[:-1]]
+        for j in range(block.shape[1]):
+            values = block[order,j]
+            for g in range(num_group):
+                group_values = values[start[g]:end[g]]
+                group_values = group_values[~np.isnan(group_values)]
+                if len(group_values) > 0:
+                    pos = np.array(quantile_list)*(len(group_values)-1)
+                    lo = np.floor(pos).astype(int)
+                    hi = np.ceil(pos).astype(int)
+                    part = np.partition(group_values,np.unique(np.r_[lo,hi]))
+                    quant[g,:,j] = part[lo]+(part[hi]-part[lo])*(pos-lo)
+        return np.concatenate([out,quant],axis=1)
+
+
+    """
+    Aggregation cube: sum, count, mean and median of the columns in var_list for each group of key_list.
+    The groups are computed once for all statistics. Cubes are cached (least recently used first out, at most
+    CUBE_CACHE_SIZE) under a fingerprint of the key and value columns (hash of their rows), the keys and the columns,
+    so plots of the same groups reuse them, and any change of the data (including self.loc[...] = ... or direct edits
+    of the arrays) gives a new cube. Hashing the rows is much cheaper than the grouped median.
+    IN:
+        key_list: list of strings. Must be column name of the DataFrame object
+        var_list: string or list of strings. Must be numeric column names of the DataFrame object
+    OUT:
+        cube: pd.DataFrame indexed by the groups, with columns (variable, statistic). Must not be modified
+    """
+    @profile
+    def agg_cube(self,key_list,var_list):
+        if isinstance(var_list,str):
+            var_list = [var_list]
+        row_hash = pd.util.hash_pandas_object(self[list(key_list)+var_list],index=False).to_numpy()
+        cache_key = (self.shape,tuple(key_list),tuple(var_list),int(row_hash.sum()),int(np.bitwise_xor.reduce(row_hash)))
+        if self._cube_cache == None:
+            self._cube_cache = OrderedDict()
+        if cache_key in self._cube_cache:
+            self._cube_cache.move_to_end(cache_key)
+            return self._cube_cache[cache_key]
+        grouped = self.groupby(key_list,observed=True)[var_list]
+        var_sum = grouped.sum()
+        var_count = grouped.count()
+        cube = pd.concat({'sum':var_sum,'count':var_count,'mean':var_sum/var_count,'median':grouped.median()},axis=1)
+        cube = cube.swaplevel(axis=1)[[(i,j) for i in var_list for j in CUBE_STATS]]
+        self._cube_cache[cache_key] = cube
+        if len(self._cube_cache) > CUBE_CACHE_SIZE:
+            self._cube_cache.popitem(last=False)
+        return cube
+        
+        
+    """
+    Drop the cached aggregation cubes (e.g. to free their memory). Called by the methods that modify the data.
+    Not needed for correctness, since the cubes are keyed on the content of the data (see agg_cube).
+    """
+    def invalidate_cache(self):
+        self._cube_cache = None
+        
+        
+    """
+    Linear regression with high-dimensional fixed effects and clustered standard errors, without dense dummy columns.
+    See my_regression.sparse_reg. Rows with missing values are dropped.
+    IN:
+        y: string. Dependent variable
+        x_list: list of strings. Regressors
+        fe_list=[]: list of strings. Columns of fixed effects (e.g. ['State_County','Year_Mortgage'])
+        cluster=None: string. Column of clusters for the standard errors
+        method='demean': 'demean' (iterative demeaning) or 'lsqr' (scipy sparse least squares)
+        robust=False: heteroskedasticity-robust standard errors if True (ignored when clustering)
+        print_flag=True: display the table if True
+    OUT:
+        out_data: pd.DataFrame of coefficients, standard errors, t statistics and p values
+    """
+    @profile
+    def sparse_ols(self,y,x_list,fe_list=[],cluster=None,method='demean',robust=False,print_flag=True):
+        from my_regression import sparse_reg
+        model = sparse_reg(self,y,x_list,fe_list,cluster)
+        out_data = model.fit(method,robust)
+        if print_flag:
+            print('Dependent variable: {}, observations: {}, fixed effects: {}'.format(y,model.nobs,','.join(fe_list) or 'None'))
+            print(tabulate(out_data.reset_index(),headers='keys',showindex=False))
+        return out_data
+        
+        
     """
     Plot the bar chart from the numeric data series by groups
     IN:
@@ -197,18 +650,12 @@ class mortgage_pd(pd.DataFrame):
         temp_plot: plot handle
         out_dic: export orded index as user defined index 
     """
+    @profile
     def my_plot(self,var_name,group_verti,group_horiz,method='sum',title=None,only_first_n=10,other_var=True,axis=None,legend_on=False,wid=0.6,figs=(7,5),stack=True,dic=None):
         group_list = [group_verti,group_horiz]
-        if method == 'sum':
-            var_by_group = self.groupby(group_list)[var_name].sum()
-        elif method == 'count':
-            var_by_group = self.groupby(group_list)[var_name].count()
-        elif method == 'median':
-            var_by_group = self.groupby(group_list)[var_name].median()
-        elif method == 'mean':
-            var_by_group = self.groupby(group_list)[var_name].mean()      
-        else:
+        if method not in CUBE_STATS:
             raise NameError('Wrong Method')
+        var_by_group = self.agg_cube(group_list,var_name)[(var_name,method)]
         var_by_group = var_by_group.unstack(level=1) #convert to matrix to be plotted
         only_first_n = min(only_first_n,len(var_by_group))
         var_by_group['total'] = var_by_group.sum(axis=1) #used for ordering
@@ -241,17 +688,27 @@ class mortgage_pd(pd.DataFrame):
                 
      
     """
-    Call my_plot. Generate 2 by 2 subplots.
+    Call my_plot. Generate 2 by 2 subplots. The four panels read from the same cached aggregation cube (see agg_cube).
     IN:
         verti: category along the Y-axis
         horiz: category along the X-axis 
         super_title: the overall title of the plot
         out_path='': export path for the plot
+        fig=None: matplotlib Figure to draw on (e.g. a matplotlib.figure.Figure for headless rendering). A pyplot figure is created if None
+        format_list=('png',): exported file formats
     EXPORT:
         f: plot
+    OUT:
+        path_list: list of paths of the exported files
     """
-    def my_subplot(self,horiz,verti,super_title,out_path='',var_investigate='mortgage_in_thousands'):
-        f,axes = plt.subplots(nrows=2,ncols=2,figsize=(20,20))
+    @profile
+    def my_subplot(self,horiz,verti,super_title,out_path='',var_investigate='mortgage_in_thousands',fig=None,format_list=('png',)):
+        if fig == None:
+            import matplotlib.pyplot as plt
+            f,axes = plt.subplots(nrows=2,ncols=2,figsize=(20,20))
+        else:
+            f = fig
+            axes = f.subplots(nrows=2,ncols=2)
         _,in_dic = self.my_plot(var_investigate,group_horiz=horiz,group_verti=verti, \
                                 method='sum',only_first_n=10,title='Total',other_var=True,axis=axes[0,0],legend_on=False)
         self.my_plot(var_investigate,group_horiz=horiz,group_verti=verti, \
@@ -264,16 +721,95 @@ class mortgage_pd(pd.DataFrame):
         f.set_figwidth(10)
         f.subplots_adjust(wspace=0.3,hspace=0.5)
         f.suptitle(super_title,fontsize='large')
-        if out_path=='':
-            f.savefig('{}.png'.format(super_title),bbox_inches='tight')    
-        else:
-            f.savefig('{}\\{}.png'.format(out_path,super_title),bbox_inches='tight')
+        path_list = [os.path.join(out_path,'{}.{}'.format(super_title,file_format)) for file_format in format_list]
+        for file_path in path_list:
+            f.savefig(file_path,bbox_inches='tight')
+        return path_list
         
      
 
         
             
 
+"""
+Hash index of the identifier columns of a DataFrame (e.g. App_ID, Employer_ID, SSN_deidentified, Year_Mortgage).
+Each row is hashed once into a 64-bit key. The index keeps the number of rows of each key, and flags the rows whose key
+was already seen (the rows drop_duplicates(keep='first') removes). It is updated incrementally when new rows are appended,
+so only the new rows are hashed.
+"""
+class key_index(object):
+    
+    """
+    Initialization
+    IN:
+        data=None: DataFrame to index
+        var_list=None: list of strings. Identifier columns
+    """
+    def __init__(self,data=None,var_list=None):
+        self.var_list = list(var_list)
+        self.key_hash = np.empty(0,dtype=np.uint64)
+        self.key_count = pd.Series(dtype=np.int64)
+        self.flag_unique_duplicate = np.empty(0,dtype=bool)
+        if data is not None:
+            self.append(data)
+            
+            
+    """
+    Number of rows indexed.
+    """
+    def __len__(self):
+        return len(self.key_hash)
+        
+        
+    """
+    Add the rows of a DataFrame (e.g. a new wave) to the index.
+    IN:
+        data: DataFrame with the identifier columns
+    OUT:
+        new_flag: np.array of booleans, True for the new rows whose key was already seen
+    """
+    def append(self,data):
+        new_hash = pd.util.hash_pandas_object(data[self.var_list],index=False).to_numpy()
+        new_flag = pd.Series(new_hash).duplicated().to_numpy() | np.isin(new_hash,self.key_count.index.to_numpy())
+        self.key_count = self.key_count.add(pd.Series(new_hash).value_counts(),fill_value=0).astype(np.int64)
+        self.key_hash = np.concatenate([self.key_hash,new_hash])
+        self.flag_unique_duplicate = np.concatenate([self.flag_unique_duplicate,new_flag])
+        return new_flag
+        
+        
+    """
+    Flag the rows whose key appears more than once (DataFrame.duplicated(keep=False)).
+    OUT:
+        np.array of booleans
+    """
+    def flag_duplicate(self):
+        return self.key_count.reindex(self.key_hash).to_numpy() > 1
+        
+        
+    """
+    Count duplicates from the key counts only.
+    OUT:
+        num_duplicate: number of rows whose key appears more than once
+        total_unique: number of distinct keys
+        num_unique_duplicate: number of distinct keys that appear more than once
+    """
+    def count_duplicate(self):
+        flag_count = self.key_count > 1
+        return self.key_count[flag_count].sum(),len(self.key_count),flag_count.sum()
+        
+        
+    """
+    Keep only some rows in the index (e.g. after dropping duplicates from the data).
+    IN:
+        keep_flag: np.array of booleans aligned with the indexed rows
+    """
+    def keep(self,keep_flag):
+        self.key_hash = self.key_hash[keep_flag]
+        self.flag_unique_duplicate = pd.Series(self.key_hash).duplicated().to_numpy()
+        self.key_count = pd.Series(self.key_hash).value_counts()
+        
+    
+    
 """
 Generate data for analysis
 """
@@ -281,26 +817,437 @@ class mortgage_data(object):
     
     """
     Read the loan data and the institution data.
+    By default both files are read at once. If chunksize is given, the files are streamed chunk by chunk,
+    and each chunk is normalized (see stream_csv) before it is kept, so raw object columns never exist for the whole file.
     IN:
         in_path='': directory of data
+        schema=None: dictionary of declared column types, keys are 'numeric', 'category' and 'id'. Default is PSID_SCHEMA
+        chunksize=None: number of rows per chunk. Read the whole file at once if None
+        usecols=None: list of strings. Only read these columns if specified. Each file reads the columns of the list
+                      that it has, and always the merge keys (MERGE_KEYS)
+        regex_string='': user defined missing value pattern, see mortgage_pd.set_missing
+        cache_dir=None: directory of the on-disk cache (see my_cache.data_cache). If specified, the parsed data is reloaded
+                        from the cache when the input files and the parameters are unchanged, and saved to it otherwise
+        flag_load=True: if False, only locate the files without reading them (e.g. to merge partitions spilled to disk)
     MODIFY:
-        Add self.loan_data and self.insti_data attributes
+        Add self.ind_data and self.fam_data attributes
     """
-    def __init__(self,in_path=''):
+    @profile
+    def __init__(self,in_path='',schema=None,chunksize=None,usecols=None,regex_string='',cache_dir=None,flag_load=True):
         path_str = ''
         if in_path != '':
             path_str = in_path + '\\'
-        self.ind_data = mortgage_pd(pd.read_csv(path_str+"PSID_1968_2013_Individual.csv",low_memory=False,skipinitialspace=True,keep_default_na=False))
-        self.fam_data = mortgage_pd(pd.read_csv(path_str+"PSID_1968_2013_family.csv",low_memory=False,skipinitialspace=True,keep_default_na=False))
+        self.ind_file = path_str+"PSID_1968_2013_Individual.csv"
+        self.fam_file = path_str+"PSID_1968_2013_family.csv"
+        self.cache = None
+        if not flag_load:
+            return
+        if cache_dir != None:
+            self.cache = data_cache(cache_dir)
+            self.load_key = data_cache.make_key([self.ind_file,self.fam_file],schema=schema,chunksize=chunksize, \
+                                                usecols=usecols,regex_string=regex_string)
+            ind_data = self.cache.load('ind_data',self.load_key)
+            fam_data = self.cache.load('fam_data',self.load_key)
+            if ind_data is not None and fam_data is not None:
+                self.ind_data = mortgage_pd(ind_data)
+                self.fam_data = mortgage_pd(fam_data)
+                return
+        read_cols = None
+        if usecols != None:
+            #the two files have different columns: select by name so that a column missing from one file is skipped
+            wanted = set(usecols) | set(MERGE_KEYS)
+            read_cols = lambda col: col in wanted
+        if chunksize == None:
+            self.ind_data = mortgage_pd(pd.read_csv(self.ind_file,low_memory=False,skipinitialspace=True,keep_default_na=False,usecols=read_cols))
+            self.fam_data = mortgage_pd(pd.read_csv(self.fam_file,low_memory=False,skipinitialspace=True,keep_default_na=False,usecols=read_cols))
+        else:
+            self.ind_data = self.concat_chunks(self.stream_csv(self.ind_file,schema,chunksize,read_cols,regex_string))
+            self.fam_data = self.concat_chunks(self.stream_csv(self.fam_file,schema,chunksize,read_cols,regex_string))
+            self.type_id(self.ind_data,schema)
+            self.type_id(self.fam_data,schema)
+        if self.cache != None:
+            self.cache.save('ind_data',self.load_key,self.ind_data)
+            self.cache.save('fam_data',self.load_key,self.fam_data)
+        
+        
+    """
+    Read a csv file chunk by chunk with declared column types.
+    For each chunk, set missing entries, convert numeric columns and convert categorical columns to pd.Categorical.
+    Id columns are kept as strings, see type_id. Columns of the schema that are not in the file are ignored.
+    IN:
+        file_path: path of the csv file
+        schema=None: dictionary of declared column types, keys are 'numeric', 'category' and 'id'. Default is PSID_SCHEMA
+        chunksize=100000: number of rows per chunk
+        usecols=None: list of strings, or function of the column name returning True for the columns to read. Only read these columns if specified
+        regex_string='': user defined missing value pattern, see mortgage_pd.set_missing
+    OUT:
+        generator of mortgage_pd chunks
+    """
+    @staticmethod
+    def stream_csv(file_path,schema=None,chunksize=100000,usecols=None,regex_string=''):
+        if schema == None:
+            schema = PSID_SCHEMA
+        dtype_dict = {i:str for key in schema for i in schema[key]}
+        reader = pd.read_csv(file_path,chunksize=chunksize,usecols=usecols,dtype=dtype_dict,skipinitialspace=True,keep_default_na=False)
+        for chunk in reader:
+            chunk = mortgage_pd(chunk)
+            chunk.set_missing(regex_string,inplace=True)
+            chunk.type_num([i for i in schema.get('numeric',[]) if i in chunk.columns])
+            for i in schema.get('category',[]):
+                if i in chunk.columns:
+                    chunk[i] = chunk[i].astype('category')
+            yield chunk
+            
+            
+    """
+    Convert the id columns of data read by stream_csv to numbers, kept as strings if any value of the column is not
+    numeric. The type is decided on the whole column, so that an id has the same type in every chunk and in both files.
+    IN:
+        data: mortgage_pd DataFrame
+        schema=None: dictionary of declared column types, see stream_csv. Default is PSID_SCHEMA
+    MODIFY:
+        Change data types of the id columns
+    """
+    @staticmethod
+    def type_id(data,schema=None):
+        if schema == None:
+            schema = PSID_SCHEMA
+        for i in schema.get('id',[]):
+            if i in data.columns:
+                try:
+                    data[i] = pd.to_numeric(data[i])
+                except ValueError:
+                    pass
+        
+        
+    """
+    Concatenate chunks produced by stream_csv. Categorical columns share the union of the categories of all chunks,
+    so they stay categorical after concatenation.
+    IN:
+        chunk_iter: iterable of mortgage_pd chunks
+    OUT:
+        mortgage_pd DataFrame type
+    """
+    @staticmethod
+    def concat_chunks(chunk_iter):
+        chunk_list = list(chunk_iter)
+        if len(chunk_list) == 0:
+            return mortgage_pd()
+        for i in chunk_list[0].select_dtypes(include=['category']).columns:
+            all_cat = union_categoricals([chunk[i] for chunk in chunk_list]).categories
+            for chunk in chunk_list:
+                chunk[i] = chunk[i].cat.set_categories(all_cat)
+        return mortgage_pd(pd.concat(chunk_list,ignore_index=True))
         
         
     """
-    Generate merge_data.
+    Cast the columns of a partition to the data types of the existing data, so that the appended rows hash (see
+    key_index) and concatenate like the existing rows. Values of object columns and of categorical columns of strings
+    become strings. Integer columns with missing values become float64 and integer columns whose values do not fit the
+    existing type become int64. Columns that cannot be converted are kept as they are.
+    IN:
+        part: DataFrame of the new rows
+        dtypes: pd.Series of data types of the existing data (DataFrame.dtypes)
+    MODIFY:
+        Change data types of the columns of part
+    """
+    @staticmethod
+    def cast_like(part,dtypes):
+        #object columns of the loaded files hold strings
+        to_str = lambda col: col.astype(str).where(col.notnull())
+        for i in part.columns.intersection(dtypes.index):
+            col,dtype = part[i],dtypes[i]
+            if col.dtype == dtype:
+                continue
+            try:
+                if isinstance(dtype,pd.CategoricalDtype):
+                    cat_dtype = dtype.categories.dtype
+                    if not isinstance(col.dtype,pd.CategoricalDtype) and col.dtype != cat_dtype:
+                        col = to_str(col) if pd.api.types.is_object_dtype(cat_dtype) else pd.to_numeric(col).astype(cat_dtype)
+                    col = col.astype('category')
+                elif pd.api.types.is_integer_dtype(dtype):
+                    col = pd.to_numeric(col)
+                    if col.notnull().all() and (col == np.floor(col)).all():
+                        info = np.iinfo(dtype)
+                        flag_fit = len(col) == 0 or (col.min() >= info.min and col.max() <= info.max)
+                        col = col.astype(dtype if flag_fit else np.int64)
+                elif pd.api.types.is_float_dtype(dtype):
+                    col = pd.to_numeric(col)
+                    col = col.astype(np.result_type(dtype,col.dtype))
+                elif pd.api.types.is_object_dtype(dtype):
+                    col = to_str(col)
+            except (ValueError,TypeError):
+                continue
+            part[i] = col
+            
+            
+    """
+    Generate merge_data. If the object was created with a cache_dir, merge_data is reloaded from the cache
+    when the input files and the parameters are unchanged.
+    IN:
+        regex_string='': user defined missing value pattern, see mortgage_pd.set_missing
+        numeric_list=NUMERIC_LIST: list of strings. Columns converted to numeric
+        flag_compact=True: compact the memory of merge_data if True, see mortgage_pd.compact
+        engine='memory': 'memory' merges the whole data at once. 'partition' merges wave by wave (see iter_merge),
+                         so the full merge and its copies never exist at once. Rows are then ordered by wave
+        n_jobs=None: number of processes used to merge the partitions (engine='partition' only)
+    MODIFY:
+        Add self.merge_data attribute
     """
-    def mortgage_init(self):
-        merge_data = mortgage_pd(pd.merge(self.ind_data,self.fam_data,how='left',on=['Year_Mortgage','Family_ID','SSN_deidentified']))
-        self.merge_data = merge_data.set_missing()
-        numeric_list = ['family_income','mortgage_in_thousands','Number_of_People','Total_Family_Debt','Welfare_Receipt']    
-        self.merge_data.type_num(numeric_list)
+    @profile
+    def mortgage_init(self,regex_string='',numeric_list=NUMERIC_LIST,flag_compact=True,engine='memory',n_jobs=None):
+        if self.cache != None:
+            merge_key = data_cache.make_key([],load_key=self.load_key,regex_string=regex_string,numeric_list=numeric_list, \
+                                            flag_compact=flag_compact,engine=engine)
+            merge_data = self.cache.load('merge_data',merge_key)
+            if merge_data is not None:
+                self.merge_data = mortgage_pd(merge_data)
+                return
+        if engine == 'memory':
+            self.merge_data = self.merge_partition(self.ind_data,self.fam_data,regex_string,numeric_list)
+        elif engine == 'partition':
+            self.merge_data = self.concat_chunks(merge_part for _,merge_part in self.iter_merge(regex_string,numeric_list,n_jobs=n_jobs))
+        else:
+            raise NameError('Wrong Engine')
         self.merge_data['mortgage_type'] = self.merge_data.set_category()
-    
\ No newline at end of file
+        if flag_compact:
+            self.merge_data.compact(print_flag=False)
+        if self.cache != None:
+            self.cache.save('merge_data',merge_key,self.merge_data)
+            
+            
+    """
+    Merge individual and family data (or one partition of them), set missing entries and convert numeric columns.
+    IN:
+        ind_part: DataFrame of individual data
+        fam_part: DataFrame of family data
+        regex_string='': user defined missing value pattern, see mortgage_pd.set_missing
+        numeric_list=NUMERIC_LIST: list of strings. Columns converted to numeric
+    OUT:
+        merge_part: mortgage_pd DataFrame type, without mortgage_type
+    """
+    @staticmethod
+    def merge_partition(ind_part,fam_part,regex_string='',numeric_list=NUMERIC_LIST):
+        merge_part = mortgage_pd(pd.merge(ind_part,fam_part,how='left',on=MERGE_KEYS))
+        merge_part.set_missing(regex_string,inplace=True)
+        merge_part.type_num(numeric_list)
+        return merge_part
+        
+        
+    """
+    Split a csv file into one csv file per wave, reading it chunk by chunk, so that waves can be merged
+    without loading the whole file. Entries are kept as raw strings. Rows without a wave go to <prefix>_.csv.
+    Partitions are written to temporary files which replace the partition files of the same prefix at the end, so
+    that running it again on the same directory does not append the rows twice.
+    IN:
+        file_path: path of the csv file
+        out_dir: directory of the partition files, named <prefix>_<wave>.csv
+        prefix: 'ind' or 'fam'
+        chunksize=100000: number of rows per chunk
+    OUT:
+        part_list: sorted list of waves
+    """
+    @staticmethod
+    def spill_partitions(file_path,out_dir,prefix,chunksize=100000):
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        is_part = lambda f,ext: f.startswith(prefix+'_') and f.endswith(ext)
+        for f in os.listdir(out_dir):
+            if is_part(f,'.csv.tmp'):
+                os.remove(os.path.join(out_dir,f))
+        part_set = set()
+        for chunk in pd.read_csv(file_path,chunksize=chunksize,dtype=str,skipinitialspace=True,keep_default_na=False):
+            for part,part_data in chunk.groupby(MERGE_KEYS[0],dropna=False):
+                part = '' if pd.isnull(part) else part
+                tmp_path = os.path.join(out_dir,'{}_{}.csv.tmp'.format(prefix,part))
+                part_data.to_csv(tmp_path,mode='a',header=part not in part_set,index=False)
+                part_set.add(part)
+        for f in os.listdir(out_dir):
+            if is_part(f,'.csv'):
+                os.remove(os.path.join(out_dir,f))
+        for part in part_set:
+            part_path = os.path.join(out_dir,'{}_{}.csv'.format(prefix,part))
+            os.replace(part_path+'.tmp',part_path)
+        return sorted(part_set)
+        
+        
+    """
+    Generate the individual and family data wave by wave.
+    IN:
+        part_dir=None: directory of the partition files written by spill_partitions. Use ind_data and fam_data if None
+    OUT:
+        generator of (wave, individual partition, family partition). The family partition is empty if the wave is missing.
+        Rows without a wave form one more partition (wave NaN), merged with the family rows without a wave
+    """
+    def iter_partitions(self,part_dir=None):
+        if part_dir == None:
+            #NaN keys do not compare equal, None stands for the missing wave in the lookup
+            part_key = lambda part: None if pd.isnull(part) else part
+            fam_group = {part_key(part):fam_part for part,fam_part in self.fam_data.groupby(MERGE_KEYS[0],observed=True,dropna=False)}
+            for part,ind_part in self.ind_data.groupby(MERGE_KEYS[0],observed=True,dropna=False):
+                yield part,ind_part,fam_group.pop(part_key(part),self.fam_data.iloc[0:0])
+        else:
+            read_csv = lambda f,n=None: pd.read_csv(os.path.join(part_dir,f),nrows=n,low_memory=False,skipinitialspace=True,keep_default_na=False)
+            file_list = sorted(os.listdir(part_dir))
+            part_list = [f[4:-4] for f in file_list if f.startswith('ind_') and f.endswith('.csv')]
+            fam_empty = read_csv([f for f in file_list if f.startswith('fam_') and f.endswith('.csv')][0],0)
+            for part in part_list:
+                ind_part = read_csv('ind_{}.csv'.format(part))
+                if 'fam_{}.csv'.format(part) in file_list:
+                    fam_part = read_csv('fam_{}.csv'.format(part))
+                else:
+                    fam_part = fam_empty
+                yield part,ind_part,fam_part
+                
+                
+    """
+    Merge the data wave by wave (see merge_partition). Partitions can be merged in parallel. At most 2*n_jobs partitions
+    are in flight at once.
+    IN:
+        regex_string='': user defined missing value pattern, see mortgage_pd.set_missing
+        numeric_list=NUMERIC_LIST: list of strings. Columns converted to numeric
+        part_dir=None: directory of the partition files written by spill_partitions. Use ind_data and fam_data if None
+        n_jobs=None: number of processes. Merge in the current process if None
+    OUT:
+        generator of (wave, merged partition), ordered by wave
+    """
+    def iter_merge(self,regex_string='',numeric_list=NUMERIC_LIST,part_dir=None,n_jobs=None):
+        if n_jobs == None:
+            for part,ind_part,fam_part in self.iter_partitions(part_dir):
+                yield part,self.merge_partition(ind_part,fam_part,regex_string,numeric_list)
+            return
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            future_list = deque()
+            for part,ind_part,fam_part in self.iter_partitions(part_dir):
+                future_list.append((part,pool.submit(self.merge_partition,ind_part,fam_part,regex_string,numeric_list)))
+                if len(future_list) >= 2*n_jobs:
+                    part,future = future_list.popleft()
+                    yield part,future.result()
+            while future_list:
+                part,future = future_list.popleft()
+                yield part,future.result()
+                
+                
+    """
+    Merge the data wave by wave and write each merged partition to a Feather file, so that the full merge never
+    exists in memory. The median income-to-loan ratio of all waves is returned, so partitions read back later can be
+    classified consistently with set_category(med=...).
+    IN:
+        out_dir: directory of the merged files, named merge_<wave>.feather
+        regex_string='': user defined missing value pattern, see mortgage_pd.set_missing
+        numeric_list=NUMERIC_LIST: list of strings. Columns converted to numeric
+        part_dir=None: directory of the partition files written by spill_partitions. Use ind_data and fam_data if None
+        n_jobs=None: number of processes
+    OUT:
+        path_list: list of paths of the merged files
+        med: median income-to-loan ratio
+    """
+    @profile
+    def write_merge(self,out_dir,regex_string='',numeric_list=NUMERIC_LIST,part_dir=None,n_jobs=None):
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        path_list = []
+        ratio_list = []
+        for part,merge_part in self.iter_merge(regex_string,numeric_list,part_dir,n_jobs):
+            ratio_list.append((merge_part.mortgage_in_thousands/merge_part.family_income).to_numpy(dtype=float))
+            path_list.append(os.path.join(out_dir,'merge_{}.feather'.format(part)))
+            merge_part.reset_index(drop=True).to_feather(path_list[-1])
+        med = pd.Series(np.concatenate(ratio_list) if ratio_list else []).median()
+        return path_list,med
+        
+        
+    """
+    Build the QA state of merge_data, kept up to date by append_wave: missing counts of all columns, key_index of the
+    identifier columns, running moments and per-group outlier sketches of the numeric columns, and the median
+    income-to-loan ratio used to classify the appended waves. Called by append_wave if needed, after mortgage_init.
+    IN:
+        var_list=NUMERIC_LIST: list of strings. Numeric columns to follow
+        key_list=MERGE_KEYS: list of strings. Identifier columns
+        category=None: list of strings. Groups of the outlier statistics (e.g. ['State_County'])
+        eps=0.001: normalized rank error of the outlier sketches, see my_sketch.group_sketch
+    MODIFY:
+        Add self.qa_state and self.wave_qa attributes
+    """
+    @profile
+    def qa_init(self,var_list=NUMERIC_LIST,key_list=MERGE_KEYS,category=None,eps=0.001):
+        from my_sketch import running_moments, group_sketch
+        self.qa_state = {'rows':len(self.merge_data),
+                         'missing':self.merge_data.isnull().sum(),
+                         'key_idx':key_index(self.merge_data,key_list),
+                         'moments':running_moments(var_list),
+                         'sketch':group_sketch(var_list,category,eps),
+                         'med':(self.merge_data.mortgage_in_thousands/self.merge_data.family_income).median()}
+        self.qa_state['moments'].update(self.merge_data)
+        self.qa_state['sketch'].update(self.merge_data)
+        self.wave_qa = dict()
+        
+        
+    """
+    Add a new wave to merge_data. Only the files of the wave are read and merged (see merge_partition), its mortgage_type
+    is set with the median of the existing data, its columns are cast to the data types of merge_data (see cast_like),
+    and the QA state (see qa_init) is updated without reading the existing rows again. Display and keep the QA deltas
+    of the wave.
+    IN:
+        ind_file: path of the individual csv file of the wave
+        fam_file: path of the family csv file of the wave
+        regex_string='': user defined missing value pattern, see mortgage_pd.set_missing
+        numeric_list=NUMERIC_LIST: list of strings. Columns converted to numeric
+        print_flag=True: display the QA deltas if True
+    OUT:
+        wave_report: dictionary with
+            wave: list of waves in the files
+            rows: number of rows of the wave
+            key_seen: number of rows of the wave whose key was already in the data or earlier in the wave
+            duplicate_before, duplicate_after: duplicate percentage of the identifier (see mortgage_pd.check_unique)
+            columns: pd.DataFrame indexed by the followed columns with the missing percentage, the mean and the
+                     outlier percentage of the wave, and the missing percentage and the mean before and after the append
+    MODIFY:
+        Append the wave to self.merge_data. Update self.qa_state and add the report to self.wave_qa
+    """
+    @profile
+    def append_wave(self,ind_file,fam_file,regex_string='',numeric_list=NUMERIC_LIST,print_flag=True):
+        from my_sketch import running_moments, sketch_flag
+        if getattr(self,'qa_state',None) == None:
+            self.qa_init()
+        state = self.qa_state
+        read_csv = lambda f: pd.read_csv(f,low_memory=False,skipinitialspace=True,keep_default_na=False)
+        merge_part = self.merge_partition(read_csv(ind_file),read_csv(fam_file),regex_string,numeric_list)
+        merge_part['mortgage_type'] = merge_part.set_category(med=state['med'])
+        self.cast_like(merge_part,self.merge_data.dtypes)
+        var_list = state['moments'].var_list
+        wave_moments = running_moments(var_list)
+        wave_moments.update(merge_part)
+        #statistics before the append
+        missing_before = state['missing']/state['rows']*100
+        mean_before = state['moments'].stats()['Mean']
+        num_duplicate,_,_ = state['key_idx'].count_duplicate()
+        duplicate_before = num_duplicate/len(state['key_idx'])*100
+        #incremental update
+        state['rows'] += len(merge_part)
+        state['missing'] = state['missing'].add(merge_part.isnull().sum(),fill_value=0)
+        key_seen = state['key_idx'].append(merge_part).sum()
+        state['moments'].update(merge_part)
+        state['sketch'].update(merge_part)
+        flag_data = sketch_flag(merge_part,state['sketch'].stats(),state['sketch'].category)
+        num_duplicate,_,_ = state['key_idx'].count_duplicate()
+        self.merge_data = self.concat_chunks([self.merge_data,merge_part])
+        wave_missing = merge_part.reindex(columns=var_list).isnull().mean()*100
+        out_data = pd.DataFrame({'Wave Missing %':wave_missing,
+                                 'Missing % Before':missing_before.reindex(var_list),
+                                 'Missing % After':(state['missing']/state['rows']*100).reindex(var_list),
+                                 'Wave Mean':wave_moments.stats()['Mean'],
+                                 'Mean Before':mean_before,
+                                 'Mean After':state['moments'].stats()['Mean'],
+                                 'Wave Outlier %':(flag_data==-1).sum()/flag_data.notnull().sum()*100},index=var_list)
+        out_data.index.name = 'Columns'
+        wave_list = sorted(merge_part[MERGE_KEYS[0]].dropna().unique().tolist())
+        wave_report = {'wave':wave_list,'rows':len(merge_part),'key_seen':int(key_seen),
+                       'duplicate_before':duplicate_before,'duplicate_after':num_duplicate/len(state['key_idx'])*100,
+                       'columns':out_data}
+        self.wave_qa[','.join(str(i) for i in wave_list)] = wave_report
+        if print_flag:
+            print('Wave:{} Rows:{} Keys already seen:{}'.format(','.join(str(i) for i in wave_list),len(merge_part),key_seen))
+            print(tabulate([['Duplicate Percentage Before','Duplicate Percentage After'],
+                            [wave_report['duplicate_before'],wave_report['duplicate_after']]]))
+            print(tabulate(out_data.reset_index(),headers='keys',showindex=False))
+        return wave_report
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import io
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+from my_PSID_class import mortgage_pd, mortgage_data, MERGE_KEYS, NUMERIC_LIST
+
+
+#missing value strings of the raw PSID extracts, all matched by NA_REGEX
+NA_STRING_LIST = ['NA','NAN','n/a',' NA','nan ']
+#modules of the startup benchmark, and optional modules that must not be loaded by importing the core
+STARTUP_LIST = ['pandas','my_PSID_class','my_pipeline','my_helper']
+LAZY_LIST = ['matplotlib','matplotlib.pyplot','tabulate','urllib.request','scipy','pyarrow']
+#statistics of sum_stats, for the plain pandas baseline cases (sum_stats_pandas, sum_stats_all_pandas)
+STATS_LIST = ['count','mean','std','median','min','max']
+
+
+"""
+Generate synthetic individual and family tables shaped like the PSID extracts: same column names, string entries
+as read by mortgage_data (keep_default_na=False), NA strings in the numeric columns and duplicated identifiers.
+IN:
+    num_row=10000: number of rows of the individual table
+    num_wave=10: number of waves (Year_Mortgage from 1968)
+    num_family=None: number of families. Default is num_row/(2*num_wave)
+    num_state=50: number of states
+    num_county=20: number of counties per state
+    num_employer=1000: number of employers
+    na_rate=0.05: share of NA strings in the numeric columns
+    dup_rate=0.01: share of rows of the individual table duplicating the identifiers of another row
+    family_rate=0.9: share of the individual keys found in the family table
+    seed=0: random seed
+OUT:
+    ind_data: pd.DataFrame of the individual table
+    fam_data: pd.DataFrame of the family table
+"""
+def make_psid(num_row=10000,num_wave=10,num_family=None,num_state=50,num_county=20,num_employer=1000,
+              na_rate=0.05,dup_rate=0.01,family_rate=0.9,seed=0):
+    rng = np.random.default_rng(seed)
+    if num_family == None:
+        num_family = max(1,num_row//(2*num_wave))
+    with_na = lambda values: np.where(rng.random(len(values)) < na_rate,rng.choice(NA_STRING_LIST,len(values)),values)
+    state = rng.integers(1,num_state+1,num_row)
+    county = rng.integers(1,num_county+1,num_row)
+    ind_data = pd.DataFrame({'Year_Mortgage':(1968+rng.integers(0,num_wave,num_row)).astype(str),
+                             'Family_ID':rng.integers(1,num_family+1,num_row).astype(str),
+                             'SSN_deidentified':rng.integers(1,10**9,num_row).astype(str),
+                             'App_ID':np.arange(1,num_row+1).astype(str),
+                             'Employer_ID':rng.integers(1,num_employer+1,num_row).astype(str),
+                             'State_ID':state.astype(str),
+                             'County_Code':county.astype(str),
+                             'State':np.char.add('S',state.astype(str)),
+                             'County':np.char.add('C',county.astype(str)),
+                             'State_County':np.char.add(np.char.add(state.astype(str),'_'),county.astype(str)),
+                             'mortgage_in_thousands':with_na(np.round(rng.lognormal(4.5,0.8,num_row),1).astype(str))})
+    num_dup = int(num_row*dup_rate)
+    if num_dup > 0:
+        dup_row = rng.choice(num_row,num_dup,replace=False)
+        dup_source = rng.choice(num_row,num_dup)
+        key_list = ['Year_Mortgage','Family_ID','SSN_deidentified','App_ID','Employer_ID']
+        ind_data.loc[dup_row,key_list] = ind_data.loc[dup_source,key_list].to_numpy()
+    fam_data = ind_data[MERGE_KEYS].drop_duplicates()
+    fam_data = fam_data[rng.random(len(fam_data)) < family_rate].reset_index(drop=True)
+    num_fam = len(fam_data)
+    fam_data['family_income'] = with_na(np.round(rng.lognormal(4,0.7,num_fam),1).astype(str))
+    fam_data['Number_of_People'] = with_na(rng.integers(1,9,num_fam).astype(str))
+    fam_data['Total_Family_Debt'] = with_na(np.round(rng.lognormal(2,1,num_fam),1).astype(str))
+    fam_data['Welfare_Receipt'] = with_na(rng.integers(0,2,num_fam).astype(str))
+    return ind_data,fam_data
+
+
+"""
+Write the synthetic tables of make_psid as PSID_1968_2013_Individual.csv and PSID_1968_2013_family.csv.
+IN:
+    out_dir: directory of the csv files. Created if it does not exist
+    **gen_dict: arguments of make_psid
+"""
+def write_psid(out_dir,**gen_dict):
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    ind_data,fam_data = make_psid(**gen_dict)
+    ind_data.to_csv(os.path.join(out_dir,'PSID_1968_2013_Individual.csv'),index=False)
+    fam_data.to_csv(os.path.join(out_dir,'PSID_1968_2013_family.csv'),index=False)
+
+
+"""
+Time a function call. The printed output of the call is discarded.
+IN:
+    func: function called with the output of setup (without arguments if no setup). Called repeat times for the timing,
+          and once more under tracemalloc if flag_memory
+    setup=None: function without arguments called before each call and not timed. Its output is passed to func
+    repeat=3: number of timed calls. The best one is reported
+    flag_memory=True: measure the peak of the memory allocated by the call with tracemalloc
+OUT:
+    result: dictionary with wall and cpu (seconds, best call) and peak_mb (None if not measured)
+"""
+def time_call(func,setup=None,repeat=3,flag_memory=True):
+    wall_list,cpu_list = [],[]
+    for _ in range(repeat):
+        arg = setup() if setup != None else None
+        with contextlib.redirect_stdout(io.StringIO()):
+            wall,cpu = time.perf_counter(),time.process_time()
+            func(arg) if setup != None else func()
+            wall_list.append(time.perf_counter()-wall)
+            cpu_list.append(time.process_time()-cpu)
+    peak_mb = None
+    if flag_memory:
+        arg = setup() if setup != None else None
+        with contextlib.redirect_stdout(io.StringIO()):
+            tracemalloc.start()
+            try:
+                func(arg) if setup != None else func()
+                peak_mb = tracemalloc.get_traced_memory()[1]/2**20
+            finally:
+                tracemalloc.stop()
+    return {'wall':min(wall_list),'cpu':min(cpu_list),'peak_mb':peak_mb}
+
+
+"""
+Benchmark cases of one data size: (case name, setup, function). The setups copy the data, so every call starts
+from the same state.
+"""
+def _case_list(raw_data,merge_data):
+    def raw():
+        return mortgage_pd(raw_data.copy())
+    def cleaned():
+        #input of type_num in merge_partition: raw strings with the missing entries set
+        data = raw()
+        data.set_missing(inplace=True)
+        return data
+    def merged():
+        return mortgage_pd(merge_data.copy())
+    def loaded():
+        return mortgage_data()
+    var_list = ['mortgage_in_thousands','family_income']
+    key_list = ['App_ID','Employer_ID','SSN_deidentified','Year_Mortgage']
+    return [('mortgage_data',None,lambda: mortgage_data()),
+            ('mortgage_init',loaded,lambda data: data.mortgage_init()),
+            ('mortgage_init_partition',loaded,lambda data: data.mortgage_init(engine='partition')),
+            ('set_missing',raw,lambda data: data.set_missing(inplace=True)),
+            ('type_num',cleaned,lambda data: data.type_num(NUMERIC_LIST)),
+            ('check_outlier',merged,lambda data: data.check_outlier(var_list)),
+            ('check_outlier_category',merged,lambda data: data.check_outlier(var_list,category=['State_County'])),
+            ('check_outlier_sketch',merged,lambda data: data.check_outlier(var_list,method='sketch',category=['State_County'])),
+            ('check_missing',merged,lambda data: data.check_missing(var_list)),
+            ('check_unique',merged,lambda data: data.check_unique(key_list)),
+            ('sum_stats',merged,lambda data: data.sum_stats(var_list,by=['Year_Mortgage'])),
+            ('sum_stats_pandas',merged,lambda data: pd.DataFrame(data).groupby(['Year_Mortgage'])[var_list].agg(STATS_LIST)),
+            ('sum_stats_all',merged,lambda data: data.sum_stats(var_list)),
+            ('sum_stats_all_pandas',merged,lambda data: pd.DataFrame(data)[var_list].agg(STATS_LIST)),
+            ('agg_cube',merged,lambda data: data.agg_cube(['Year_Mortgage','State'],var_list))]
+
+
+"""
+Measure the import time of modules, each in a fresh interpreter, and list the optional modules (LAZY_LIST) the
+import loaded. pandas is measured alone as the floor of the data and QA core.
+IN:
+    module_list=STARTUP_LIST: list of module names
+    repeat=3: number of fresh interpreters per module. The best time is reported
+OUT:
+    result_list: list of dictionaries with case (import_<module>), rows (0), wall (seconds) and loaded
+                 (list of the optional modules loaded)
+"""
+def startup_benchmark(module_list=STARTUP_LIST,repeat=3):
+    import subprocess
+    code = 'import sys,time,json;start=time.perf_counter();import {};wall=time.perf_counter()-start;' \
+           'print(json.dumps([wall,[i for i in {} if i in sys.modules]]))'
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ,PYTHONPATH=os.pathsep.join([package_dir]+[os.environ.get('PYTHONPATH','')]).rstrip(os.pathsep))
+    result_list = []
+    for module in module_list:
+        wall_list = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable,'-c',code.format(module,LAZY_LIST)],env=env,cwd=package_dir,
+                                 capture_output=True,text=True,check=True).stdout
+            wall,loaded = json.loads(out.strip().splitlines()[-1])
+            wall_list.append(wall)
+        result_list.append({'case':'import_'+module,'rows':0,'wall':min(wall_list),'cpu':None,'peak_mb':None,'loaded':loaded})
+        print('{:<26}{:>10}{:>10.4f}s {}'.format('import_'+module,0,min(wall_list),','.join(loaded)))
+    return result_list
+
+
+"""
+Time and memory-profile the mortgage_pd and mortgage_data entry points on synthetic data of several sizes.
+IN:
+    size_list=(10000,100000): numbers of rows of the individual table
+    case_list=None: list of strings. Names of the cases to run, all by default
+    repeat=3: number of timed calls per case
+    flag_memory=True: measure the peak memory of each case
+    out_path=None: JSON file of the results, see compare
+    flag_startup=True: also run the startup benchmark (see startup_benchmark)
+    **gen_dict: other arguments of make_psid (e.g. na_rate, dup_rate)
+OUT:
+    result: dictionary with the environment (meta) and the list of results (one dictionary per case and size)
+"""
+def run_benchmark(size_list=(10000,100000),case_list=None,repeat=3,flag_memory=True,out_path=None,flag_startup=True,**gen_dict):
+    result_list = startup_benchmark(repeat=repeat) if flag_startup else []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as data_dir:
+        try:
+            os.chdir(data_dir) #mortgage_data reads the files of the current directory
+            for num_row in size_list:
+                write_psid(data_dir,num_row=num_row,**gen_dict)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    data = mortgage_data()
+                    data.mortgage_init(flag_compact=False)
+                raw_data = pd.merge(data.ind_data,data.fam_data,how='left',on=MERGE_KEYS)
+                for name,setup,func in _case_list(raw_data,data.merge_data):
+                    if case_list != None and name not in case_list:
+                        continue
+                    result = time_call(func,setup,repeat,flag_memory)
+                    result.update(case=name,rows=num_row)
+                    result_list.append(result)
+                    print('{:<26}{:>10}{:>10.4f}s'.format(name,num_row,result['wall']))
+        finally:
+            os.chdir(cwd)
+    result = {'meta':{'time':time.strftime('%Y-%m-%d %H:%M:%S'),'python':platform.python_version(),
+                      'pandas':pd.__version__,'numpy':np.__version__,'platform':platform.platform(),
+                      'repeat':repeat,'generator':gen_dict},
+              'result':result_list}
+    if out_path != None:
+        with open(out_path,'w') as f:
+            json.dump(result,f,indent=1)
+    return result
+
+
+"""
+Compare two benchmark runs written by run_benchmark.
+IN:
+    base_path: JSON file of the reference run
+    new_path: JSON file of the new run
+    threshold=0.1: relative slowdown (or memory increase) above which a case is flagged as a regression
+    print_flag=True: display the comparison if True
+OUT:
+    out_data: pd.DataFrame indexed by case and rows with the wall time and peak memory of both runs, their ratios
+              (new/base) and a Regression flag
+"""
+def compare(base_path,new_path,threshold=0.1,print_flag=True):
+    data_list = []
+    for file_path in [base_path,new_path]:
+        with open(file_path) as f:
+            data_list.append(pd.DataFrame(json.load(f)['result']).set_index(['case','rows']))
+    base_data,new_data = data_list
+    out_data = pd.DataFrame({'Base Wall':base_data['wall'],'New Wall':new_data['wall'],
+                             'Base Peak MB':base_data['peak_mb'],'New Peak MB':new_data['peak_mb']}).dropna(subset=['Base Wall','New Wall'])
+    out_data['Wall Ratio'] = out_data['New Wall']/out_data['Base Wall']
+    out_data['Peak Ratio'] = out_data['New Peak MB'].astype(float)/out_data['Base Peak MB'].astype(float)
+    out_data['Regression'] = (out_data['Wall Ratio'] > 1+threshold) | (out_data['Peak Ratio'] > 1+threshold)
+    if print_flag:
+        from tabulate import tabulate
+        print(tabulate(out_data.reset_index(),headers='keys',showindex=False,floatfmt='.4g'))
+    return out_data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the PSID toolkit on synthetic data')
+    sub_parser = parser.add_subparsers(dest='command')
+    run_parser = sub_parser.add_parser('run',help='run the benchmark')
+    run_parser.add_argument('--sizes',type=int,nargs='+',default=[10000,100000],help='numbers of rows')
+    run_parser.add_argument('--cases',nargs='+',default=None,help='cases to run, all by default')
+    run_parser.add_argument('--repeat',type=int,default=3)
+    run_parser.add_argument('--no-memory',action='store_true',help='skip the tracemalloc run')
+    run_parser.add_argument('--no-startup',action='store_true',help='skip the startup benchmark')
+    run_parser.add_argument('--waves',type=int,default=10)
+    run_parser.add_argument('--states',type=int,default=50)
+    run_parser.add_argument('--counties',type=int,default=20)
+    run_parser.add_argument('--na-rate',type=float,default=0.05)
+    run_parser.add_argument('--dup-rate',type=float,default=0.01)
+    run_parser.add_argument('--seed',type=int,default=0)
+    run_parser.add_argument('--out',default='benchmark.json',help='JSON file of the results')
+    startup_parser = sub_parser.add_parser('startup',help='measure the import time of the modules')
+    startup_parser.add_argument('--modules',nargs='+',default=STARTUP_LIST)
+    startup_parser.add_argument('--repeat',type=int,default=3)
+    compare_parser = sub_parser.add_parser('compare',help='compare two runs')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold',type=float,default=0.1)
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_benchmark(args.sizes,args.cases,args.repeat,not args.no_memory,args.out,not args.no_startup,num_wave=args.waves,
+                      num_state=args.states,num_county=args.counties,na_rate=args.na_rate,dup_rate=args.dup_rate,seed=args.seed)
+    elif args.command == 'startup':
+        startup_benchmark(args.modules,args.repeat)
+    elif args.command == 'compare':
+        out_data = compare(args.base,args.new,args.threshold)
+        sys.exit(1 if out_data['Regression'].any() else 0)
+    else:
+        parser.print_help()
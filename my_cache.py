@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import pandas as pd
+
+
+"""
+On-disk cache of DataFrames in the Feather (Arrow IPC) columnar format.
+Each entry is stored as <name>.feather with a <name>.json file holding the key it was built with.
+The key is computed from the source files and the parameters of the pipeline, so an entry is
+invalidated automatically once an input file or a parameter changes.
+Requires pyarrow.
+"""
+class data_cache(object):
+
+    """
+    Initialization
+    IN:
+        cache_dir: directory of the cache. Created if it does not exist
+    """
+    def __init__(self,cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+
+    """
+    Build the cache key of a list of source files and pipeline parameters.
+    IN:
+        file_list: list of paths of the source files
+        flag_hash=False: hash the content of the files if True, otherwise use their size and modification time
+        **param_dict: pipeline parameters. Must be JSON serializable (otherwise converted by str)
+    OUT:
+        key: hex string
+    """
+    @staticmethod
+    def make_key(file_list,flag_hash=False,**param_dict):
+        file_mat = []
+        for file_path in file_list:
+            if flag_hash:
+                file_hash = hashlib.sha1()
+                with open(file_path,'rb') as f:
+                    for block in iter(lambda: f.read(1<<20),b''):
+                        file_hash.update(block)
+                file_mat.append([os.path.abspath(file_path),file_hash.hexdigest()])
+            else:
+                file_stat = os.stat(file_path)
+                file_mat.append([os.path.abspath(file_path),file_stat.st_size,file_stat.st_mtime_ns])
+        key_str = json.dumps({'files':file_mat,'params':param_dict},sort_keys=True,default=str)
+        return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+
+    """
+    Load an entry from the cache. The Feather file is uncompressed and memory-mapped, so the Arrow table is read without
+    an allocation of its own and the conversion to pandas makes the only in-memory copy (kept writable).
+    IN:
+        name: name of the entry (e.g. merge_data)
+        key: cache key, see make_key
+    OUT:
+        pd.DataFrame, or None if the entry does not exist or was built with another key
+    """
+    def load(self,name,key):
+        data_path = os.path.join(self.cache_dir,name+'.feather')
+        meta_path = os.path.join(self.cache_dir,name+'.json')
+        if not (os.path.isfile(data_path) and os.path.isfile(meta_path)):
+            return None
+        with open(meta_path) as f:
+            if json.load(f).get('key') != key:
+                return None
+        from pyarrow import feather
+        return feather.read_table(data_path,memory_map=True).to_pandas()
+
+
+    """
+    Save an entry to the cache. The data file is written first and then renamed, so an interrupted
+    write never leaves an entry that looks valid. It is written uncompressed so that load can memory-map it.
+    IN:
+        name: name of the entry (e.g. merge_data)
+        key: cache key, see make_key
+        data: pd.DataFrame
+    """
+    def save(self,name,key,data):
+        data_path = os.path.join(self.cache_dir,name+'.feather')
+        meta_path = os.path.join(self.cache_dir,name+'.json')
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+        if not data.index.equals(pd.RangeIndex(len(data))):
+            data = data.reset_index(drop=True)
+        data.to_feather(data_path+'.tmp',compression='uncompressed')
+        os.replace(data_path+'.tmp',data_path)
+        with open(meta_path,'w') as f:
+            json.dump({'key':key,'rows':len(data),'columns':list(data.columns)},f)
@@ -3,14 +3,23 @@
 
 import os.path
 import os
-import urllib.request as request
 import sys
+import time
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+#plotting (matplotlib) and downloading (urllib.request) modules are imported on first use
 
 """
 This is my general utility class
 """
 class utility(object):
     
+    #data of batch_render in the worker processes
+    render_data = dict()
+    
     """
     Initialization
     """
@@ -22,14 +31,15 @@ class utility(object):
     Download files from the internet. By default, the file will be downloaded 
     to the cwd, and will have the same name
     IN:
-        download_dir: target dir, by default is cwd
+        download_dir=None: target dir, by default is cwd
         file_name: target file name, by default is the same name
         url: source file link
     NOTE:
         Contains a nested function called reporthook
     """
     @staticmethod
-    def download(url,download_dir=os.getcwd(),file_name=None):
+    def download(url,download_dir=None,file_name=None):
+        import urllib.request as request
         
         
         """
@@ -54,6 +64,8 @@ class utility(object):
                 
                 
         print("Begin file downloading...")
+        if download_dir==None:
+            download_dir = os.getcwd()
         if file_name==None:
             file_name = url.rsplit('/',1)[-1]
         request.urlretrieve(url,os.path.join(download_dir,file_name),reporthook)
@@ -71,7 +83,12 @@ class utility(object):
         #if one of the axis uses index, we need to generate that variable
         if var_x_axis == 'index_var':
             input_df['index_var'] = input_df.index    
-        if method == 'sum':
+        if hasattr(input_df,'agg_cube') and method in ['sum','count','median','mean']:
+            #mortgage_pd: read from the cached aggregation cube
+            display_vars_grouped = input_df.agg_cube([var_x_axis],display_vars).xs(method,axis=1,level=1)
+            if isinstance(display_vars,str):
+                display_vars_grouped = display_vars_grouped[display_vars]
+        elif method == 'sum':
             display_vars_grouped = input_df.groupby(var_x_axis)[display_vars].sum()
         elif method == 'count':
             display_vars_grouped = input_df.groupby(var_x_axis)[display_vars].count()
@@ -102,12 +119,39 @@ class utility(object):
 
 
 
+    """
+    Generate subplots from a list of plot specifications.
+    IN:
+        input_df: data
+        subplot_dim: [rows, columns] of the subplots
+        subplot_type: plotting method, currently only 'multi_var_plot'
+        subplot_spec: list of dictionaries, keyword arguments of each subplot
+        super_title=None: the overall title of the plot
+        output_path=None: export path for the plot, by default is cwd
+        minor_locator=None, major_locator=None: locators of the x axis, by default every other Monday and every month
+        location_empty_subplot=[]: list of [row, column] of the subplots left empty
+        fig=None: matplotlib Figure to draw on (e.g. a matplotlib.figure.Figure for headless rendering). A pyplot figure is created if None
+        format_list=('png',): exported file formats
+    OUT:
+        path_list: list of paths of the exported files
+    """
     @staticmethod
     def generic_subplot(input_df, subplot_dim, subplot_type, subplot_spec, super_title = None, \
-                          output_path = os.getcwd(), minor_locator = \
-                          mdate.WeekdayLocator(byweekday=MO, interval=2), \
-                          major_locator = mdate.MonthLocator(), location_empty_subplot = []):
-        f,axes = plt.subplots(nrows = subplot_dim[0], ncols = subplot_dim[1], figsize = (15,10), sharex = 'all')
+                          output_path = None, minor_locator = None, major_locator = None, \
+                          location_empty_subplot = [], fig = None, format_list = ('png',)):
+        import matplotlib.dates as mdate
+        if output_path == None:
+            output_path = os.getcwd()
+        if minor_locator == None:
+            minor_locator = mdate.WeekdayLocator(byweekday=mdate.MO, interval=2)
+        if major_locator == None:
+            major_locator = mdate.MonthLocator()
+        if fig == None:
+            import matplotlib.pyplot as plt
+            f,axes = plt.subplots(nrows = subplot_dim[0], ncols = subplot_dim[1], figsize = (15,10), sharex = 'all', squeeze = False)
+        else:
+            f = fig
+            axes = f.subplots(nrows = subplot_dim[0], ncols = subplot_dim[1], sharex = 'all', squeeze = False)
         max_num_plot = subplot_dim[0] * subplot_dim[1]
         if len(subplot_spec) + len(location_empty_subplot) > max_num_plot:
             raise ValueError('Capacity of subplots exceeded.')
@@ -126,23 +170,294 @@ class utility(object):
                     location_empty_subplot[empty_plot_counter] != [i,j]: 
                         axes[i,j].xaxis.set_major_locator(major_locator)
                         axes[i,j].xaxis.set_minor_locator(minor_locator)
-                        plot_spec = subplot_spec[plot_counter]
+                        plot_spec = dict(subplot_spec[plot_counter])
                         plot_spec.update(dict(axis = axes[i,j]))
                         plot_counter += 1
                         if subplot_type == 'multi_var_plot':
-                            multi_var_plot(input_df, **plot_spec)           
+                            utility.multi_var_plot(input_df, **plot_spec)           
                         else:
                             raise ValueError('Wrong Plotting Method')
                     elif empty_plot_counter<len(location_empty_subplot):
                         empty_plot_counter += 1
                         axes[i,j].axis('off')          
-        plt.tight_layout()   
+        f.tight_layout()   
         f.autofmt_xdate()
         f.set_figheight(8)
         f.set_figwidth(10)
         f.subplots_adjust(wspace=0.3,hspace=0.5)
         f.suptitle(super_title,fontsize='large')
-        f.savefig('{}\{}.png'.format(output_path,super_title),bbox_inches='tight')
+        path_list = [os.path.join(output_path,'{}.{}'.format(super_title,file_format)) for file_format in format_list]
+        for file_path in path_list:
+            f.savefig(file_path,bbox_inches='tight')
+        return path_list
+        
+        
+    """
+    Render a batch of figures headless, optionally across a process pool. Each figure is drawn on its own
+    matplotlib.figure.Figure (object-oriented API, Agg backend) without the pyplot state machine.
+    IN:
+        spec_list: list of dictionaries, one per figure, with keys
+                   kind: 'my_subplot' (mortgage_pd.my_subplot) or 'generic_subplot' (utility.generic_subplot)
+                   data: key of the data in data_dict
+                   kwargs: keyword arguments of the plotting method (without fig, output path and formats)
+        data_dict: dictionary. name -> DataFrame. Sent once to each worker process
+        output_dir=cwd: export directory
+        format_list=('png',): exported file formats (e.g. ('png','svg'))
+        n_jobs=None: number of processes. Render in the current process if None
+    OUT:
+        result_list: list of dictionaries, one per figure, with keys kind, files, seconds (wall time),
+                     cpu_seconds and error (None if the figure was rendered)
+    """
+    @staticmethod
+    def batch_render(spec_list, data_dict, output_dir = None, format_list = ('png',), n_jobs = None):
+        if output_dir == None:
+            output_dir = os.getcwd()
+        if n_jobs == None:
+            utility.render_data = data_dict
+            return [utility.render_spec(spec, output_dir, format_list) for spec in spec_list]
+        with ProcessPoolExecutor(max_workers = n_jobs, initializer = utility.render_init, initargs = (data_dict,)) as pool:
+            return list(pool.map(utility.render_spec, spec_list, [output_dir]*len(spec_list), [format_list]*len(spec_list)))
+        
+        
+    """
+    Worker side of batch_render: select the Agg backend and keep the data.
+    """
+    @staticmethod
+    def render_init(data_dict):
+        import matplotlib
+        matplotlib.use('Agg')
+        utility.render_data = data_dict
+        
+        
+    """
+    Worker side of batch_render: render one figure.
+    """
+    @staticmethod
+    def render_spec(spec, output_dir, format_list):
+        from matplotlib.figure import Figure
+        result = dict(kind = spec['kind'], files = [], error = None)
+        start_time,start_cpu = time.perf_counter(),time.process_time()
+        try:
+            fig = Figure()
+            data = utility.render_data[spec['data']]
+            if spec['kind'] == 'my_subplot':
+                result['files'] = data.my_subplot(out_path = output_dir, fig = fig, format_list = format_list, **spec['kwargs'])
+            elif spec['kind'] == 'generic_subplot':
+                result['files'] = utility.generic_subplot(data, output_path = output_dir, fig = fig, format_list = format_list, **spec['kwargs'])
+            else:
+                raise ValueError('Wrong Plotting Method')
+        except Exception as e:
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+        result['seconds'] = time.perf_counter()-start_time
+        result['cpu_seconds'] = time.process_time()-start_cpu
+        return result
 
 
 
+"""
+Bulk download manager for many files (e.g. the PSID wave files).
+Files are downloaded by a thread pool, partial downloads (<file>.part) are resumed with HTTP Range requests,
+and completed files are verified against their size and checksum. A manifest (JSON file in the download directory)
+records the size, checksum, ETag and Last-Modified of each downloaded url, so files that are up to date are skipped.
+Progress is reported for all files together.
+"""
+class download_manager(object):
+    
+    """
+    Initialization
+    IN:
+        download_dir=None: target dir, by default is cwd
+        max_workers=4: maximum number of concurrent downloads
+        manifest_name='download_manifest.json': file name of the manifest
+        hash_name='sha256': checksum algorithm, any name accepted by hashlib
+        block_size=65536: bytes read at a time
+        timeout=60: socket timeout in seconds
+    """
+    def __init__(self,download_dir=None,max_workers=4,manifest_name='download_manifest.json',hash_name='sha256', \
+                 block_size=65536,timeout=60):
+        self.download_dir = os.getcwd() if download_dir == None else download_dir
+        if not os.path.isdir(self.download_dir):
+            os.makedirs(self.download_dir)
+        self.max_workers = max_workers
+        self.manifest_path = os.path.join(self.download_dir,manifest_name)
+        self.hash_name = hash_name
+        self.block_size = block_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.manifest = dict()
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        
+        
+    """
+    Download a list of files. Up-to-date files are skipped. A failed download does not stop the others.
+    IN:
+        url_list: list of source file links
+        checksum_dict=None: dictionary. url -> expected checksum (hex string of hash_name)
+        file_name_dict=None: dictionary. url -> target file name, by default is the same name
+    OUT:
+        status_dict: dictionary. url -> 'downloaded', 'skipped' or the error message
+    """
+    def fetch(self,url_list,checksum_dict=None,file_name_dict=None):
+        checksum_dict = dict() if checksum_dict == None else checksum_dict
+        file_name_dict = dict() if file_name_dict == None else file_name_dict
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            head_list = list(pool.map(self.head,url_list))
+        self.total_bytes = sum(head['size'] or 0 for head in head_list)
+        self.done_bytes = 0
+        self.done_files = 0
+        self.total_files = len(url_list)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            future_dict = dict()
+            for url,head in zip(url_list,head_list):
+                file_name = file_name_dict.get(url,url.rsplit('/',1)[-1])
+                future_dict[url] = pool.submit(self.fetch_one,url,os.path.join(self.download_dir,file_name),head,checksum_dict.get(url))
+            status_dict = dict()
+            for url in future_dict:
+                try:
+                    status_dict[url] = future_dict[url].result()
+                except Exception as e:
+                    status_dict[url] = 'failed: {}'.format(e)
+        sys.stdout.write('\n')
+        return status_dict
+        
+        
+    """
+    Query the size, ETag and Last-Modified of a url with a HEAD request.
+    IN:
+        url: source file link
+    OUT:
+        head: dictionary with keys size, etag and last_modified (None if unknown)
+    """
+    def head(self,url):
+        import urllib.request as request
+        import urllib.error
+        head = dict(size=None,etag=None,last_modified=None)
+        try:
+            with request.urlopen(request.Request(url,method='HEAD'),timeout=self.timeout) as response:
+                if response.headers.get('Content-Length') != None:
+                    head['size'] = int(response.headers['Content-Length'])
+                head['etag'] = response.headers.get('ETag')
+                head['last_modified'] = response.headers.get('Last-Modified')
+        except (urllib.error.URLError,OSError,ValueError):
+            pass
+        return head
+        
+        
+    """
+    Check whether a file is up to date: it matches its manifest entry, the remote file did not change
+    and the expected checksum (if given) is the recorded one.
+    """
+    def is_current(self,url,file_path,head,checksum):
+        entry = self.manifest.get(url)
+        if entry == None or not os.path.isfile(file_path) or os.path.getsize(file_path) != entry['size']:
+            return False
+        if checksum != None and checksum.lower() != entry['checksum']:
+            return False
+        for key in ['size','etag','last_modified']:
+            if head[key] != None and entry.get(key) != None and head[key] != entry[key]:
+                return False
+        return True
+        
+        
+    """
+    Download one file, resuming its partial download if any, and record it in the manifest. The ETag and Last-Modified
+    of the remote file are kept next to the partial download (<file>.part.json): the partial download is discarded if
+    they changed, and the resume request carries If-Range so that the server sends the whole file if it changed.
+    IN:
+        url: source file link
+        file_path: target path
+        head: output of head
+        checksum: expected checksum or None
+    OUT:
+        'downloaded' or 'skipped'
+    """
+    def fetch_one(self,url,file_path,head,checksum):
+        import urllib.request as request
+        import urllib.error
+        if self.is_current(url,file_path,head,checksum):
+            self.report(head['size'] or 0,1)
+            return 'skipped'
+        part_path = file_path+'.part'
+        #ETag and Last-Modified of the remote file that the partial download comes from
+        validator_path = part_path+'.json'
+        validator = {key:head[key] for key in ['etag','last_modified']}
+        file_hash = hashlib.new(self.hash_name)
+        offset = 0
+        if os.path.isfile(part_path):
+            part_validator = dict(etag=None,last_modified=None)
+            if os.path.isfile(validator_path):
+                with open(validator_path) as f:
+                    part_validator = json.load(f)
+            flag_changed = any(validator[key] != None and part_validator.get(key) != validator[key] for key in validator)
+            if flag_changed or (head['size'] != None and os.path.getsize(part_path) > head['size']):
+                os.remove(part_path)
+            else:
+                with open(part_path,'rb') as f:
+                    for block in iter(lambda: f.read(self.block_size),b''):
+                        file_hash.update(block)
+                        offset += len(block)
+        with open(validator_path,'w') as f:
+            json.dump(validator,f)
+        req = request.Request(url)
+        if offset > 0:
+            req.add_header('Range','bytes={}-'.format(offset))
+            #the server sends the whole file (200) instead of the range if it changed since the validator
+            if_range = validator['etag'] if validator['etag'] != None else validator['last_modified']
+            if if_range != None:
+                req.add_header('If-Range',if_range)
+        try:
+            response = request.urlopen(req,timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code != 416: #416: nothing left to download
+                raise
+            response = None
+        if response == None:
+            self.report(offset,0)
+        else:
+            with response:
+                if offset > 0 and response.status != 206: #range ignored by the server: start over
+                    file_hash = hashlib.new(self.hash_name)
+                    offset = 0
+                self.report(offset,0)
+                with open(part_path,'ab' if offset > 0 else 'wb') as f:
+                    for block in iter(lambda: response.read(self.block_size),b''):
+                        f.write(block)
+                        file_hash.update(block)
+                        self.report(len(block),0)
+        size = os.path.getsize(part_path)
+        if head['size'] != None and size != head['size']:
+            raise IOError('incomplete download of {} ({} of {} bytes)'.format(url,size,head['size']))
+        if checksum != None and file_hash.hexdigest() != checksum.lower():
+            os.remove(part_path)
+            os.remove(validator_path)
+            raise IOError('checksum mismatch for {}'.format(url))
+        os.replace(part_path,file_path)
+        os.remove(validator_path)
+        with self.lock:
+            self.manifest[url] = dict(file=os.path.basename(file_path),size=size,checksum=file_hash.hexdigest(), \
+                                      etag=head['etag'],last_modified=head['last_modified'])
+            with open(self.manifest_path+'.tmp','w') as f:
+                json.dump(self.manifest,f,indent=1)
+            os.replace(self.manifest_path+'.tmp',self.manifest_path)
+        self.report(0,1)
+        return 'downloaded'
+        
+        
+    """
+    Update and display the progress of all files.
+    IN:
+        num_bytes: bytes downloaded since the last call
+        num_files: files completed since the last call
+    """
+    def report(self,num_bytes,num_files):
+        with self.lock:
+            self.done_bytes += num_bytes
+            self.done_files += num_files
+            if self.total_bytes > 0:
+                percent = self.done_bytes * 1e2 / self.total_bytes
+                sys.stdout.write("\r%5.1f%% %*d / %d bytes, %d / %d files" % (
+                    percent, len(str(self.total_bytes)), self.done_bytes, self.total_bytes, self.done_files, self.total_files))
+            else: # total size is unknown
+                sys.stdout.write("\rread %d bytes, %d / %d files" % (self.done_bytes, self.done_files, self.total_files))
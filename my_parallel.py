@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+
+"""
+Copy a numeric array into a new shared memory block.
+IN:
+    arr: np.array. Must not be of object type
+OUT:
+    shm: SharedMemory object. Must be closed and unlinked by the caller
+    spec: (name, shape, dtype string) used by the worker processes to attach to the block
+"""
+def share_array(arr):
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True,size=max(arr.nbytes,1))
+    np.ndarray(arr.shape,dtype=arr.dtype,buffer=shm.buf)[...] = arr
+    return shm,(shm.name,arr.shape,arr.dtype.str)
+
+
+"""
+Worker side of column_map: attach to the shared blocks and call func on them.
+func must not return views of its inputs, since the blocks are closed once it returns.
+"""
+def _run_job(func,spec_list,args):
+    shm_list = [shared_memory.SharedMemory(name=spec[0]) for spec in spec_list]
+    try:
+        arr_list = [np.ndarray(spec[1],dtype=np.dtype(spec[2]),buffer=shm.buf) for spec,shm in zip(spec_list,shm_list)]
+        out = func(*arr_list,*args)
+        del arr_list
+        return out
+    finally:
+        for shm in shm_list:
+            shm.close()
+
+
+"""
+Call func once per array in a process pool. The arrays are passed to the workers through shared memory
+instead of being pickled.
+IN:
+    func: picklable function called as func(array, *shared_list, *args)
+    array_dict: dictionary. name -> numeric np.array, one job per entry
+    n_jobs: number of worker processes
+    shared_list=(): numeric np.arrays passed to every job (e.g. group codes)
+    args=(): other picklable arguments passed to every job
+OUT:
+    out_dict: dictionary. name -> return value of func
+"""
+def column_map(func,array_dict,n_jobs,shared_list=(),args=()):
+    shm_list = []
+    try:
+        shared_spec = []
+        for arr in shared_list:
+            shm,spec = share_array(arr)
+            shm_list.append(shm)
+            shared_spec.append(spec)
+        job_spec = dict()
+        for name in array_dict:
+            shm,spec = share_array(array_dict[name])
+            shm_list.append(shm)
+            job_spec[name] = spec
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            future_dict = {name:pool.submit(_run_job,func,[job_spec[name]]+shared_spec,args) for name in job_spec}
+            return {name:future_dict[name].result() for name in future_dict}
+    finally:
+        for shm in shm_list:
+            shm.close()
+            shm.unlink()
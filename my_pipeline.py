@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import re
+import pandas as pd
+from my_PSID_class import mortgage_pd, NA_REGEX
+
+
+"""
+Lazy pipeline over mortgage_pd operations. Steps are only recorded, and run in one go by collect():
+    result_data,result_list = mortgage_pipeline(data).set_missing().type_num(NUMERIC_LIST) \
+                                  .check_outlier(['family_income']).select(['family_income']).collect()
+Before running, the plan is optimized (see optimize):
+    - only the columns used by the steps or kept by select are read (column pruning)
+    - set_missing immediately followed by type_num is fused, so the converted columns are scanned once
+    - the data is never copied as a whole. Columns are shared with the source until a step changes them
+"""
+class mortgage_pipeline(object):
+
+    """
+    Initialization
+    IN:
+        data: source DataFrame. It is never modified
+    """
+    def __init__(self,data):
+        self.data = data
+        self.step_list = []
+
+
+    """
+    Record set_missing, see mortgage_pd.set_missing
+    """
+    def set_missing(self,regex_string=''):
+        self.step_list.append(('set_missing',dict(regex_string=regex_string)))
+        return self
+
+
+    """
+    Record type_num, see mortgage_pd.type_num
+    """
+    def type_num(self,var_list=[]):
+        self.step_list.append(('type_num',dict(var_list=list(var_list))))
+        return self
+
+
+    """
+    Record set_category, see mortgage_pd.set_category. The result is added as column col_name
+    """
+    def set_category(self,col_name='mortgage_type'):
+        self.step_list.append(('set_category',dict(col_name=col_name)))
+        return self
+
+
+    """
+    Record check_outlier, see mortgage_pd.check_outlier
+    """
+    def check_outlier(self,var_list,method='MAD',category=None):
+        self.step_list.append(('check_outlier',dict(var_list=list(var_list),method=method,category=category)))
+        return self
+
+
+    """
+    Record check_missing, see mortgage_pd.check_missing
+    """
+    def check_missing(self,var_list):
+        self.step_list.append(('check_missing',dict(var_list=list(var_list))))
+        return self
+
+
+    """
+    Keep only the columns in var_list in the output (columns created by the steps, e.g. by set_category, must be listed
+    to be kept). The columns used by the other steps are still read.
+    """
+    def select(self,var_list):
+        self.step_list.append(('select',dict(var_list=list(var_list))))
+        return self
+
+
+    """
+    Columns read by a step.
+    """
+    @staticmethod
+    def step_columns(name,kwargs):
+        if name == 'set_category':
+            return ['mortgage_in_thousands','family_income']
+        if name == 'check_outlier' and kwargs['category'] != None:
+            category = kwargs['category']
+            return kwargs['var_list']+([category] if isinstance(category,str) else list(category))
+        return kwargs.get('var_list',[]) if name != 'select' else []
+
+
+    """
+    Optimize the recorded steps.
+    OUT:
+        col_list: list of source columns to read
+        plan_list: list of (step name, arguments). set_missing has a num_list argument with the columns converted
+                   to numeric by a fused type_num
+    """
+    def optimize(self):
+        out_list = None
+        for name,kwargs in self.step_list:
+            if name == 'select':
+                out_list = kwargs['var_list']
+        used_set = set(self.data.columns.values if out_list == None else out_list)
+        for name,kwargs in self.step_list:
+            used_set.update(self.step_columns(name,kwargs))
+        col_list = [i for i in self.data.columns.values if i in used_set]
+        plan_list = []
+        for name,kwargs in self.step_list:
+            if name == 'select':
+                continue
+            if name == 'type_num' and len(plan_list) > 0 and plan_list[-1][0] == 'set_missing':
+                plan_list[-1][1]['num_list'] += kwargs['var_list']
+            elif name == 'set_missing':
+                plan_list.append((name,dict(kwargs,num_list=[])))
+            else:
+                plan_list.append((name,dict(kwargs)))
+        if out_list != None:
+            plan_list.append(('select',dict(var_list=out_list)))
+        return col_list,plan_list
+
+
+    """
+    Display the optimized plan.
+    """
+    def explain(self):
+        col_list,plan_list = self.optimize()
+        print('read {} of {} columns'.format(len(col_list),len(self.data.columns)))
+        for name,kwargs in plan_list:
+            print('{}({})'.format(name,', '.join('{}={}'.format(k,kwargs[k]) for k in kwargs)))
+
+
+    """
+    Run the optimized plan.
+    OUT:
+        out_data: mortgage_pd DataFrame type
+        result_list: list of (step name, output) of the check steps, in order
+    """
+    def collect(self):
+        col_list,plan_list = self.optimize()
+        #a frame made of the source columns, without copying them
+        work_data = mortgage_pd(pd.DataFrame({i:self.data[i] for i in col_list},copy=False))
+        result_list = []
+        for name,kwargs in plan_list:
+            if name == 'set_missing':
+                na_pattern = re.compile(NA_REGEX+kwargs['regex_string'],re.I)
+                for i in work_data.select_dtypes(include=['object','string']).columns:
+                    null_var = work_data.na_mask(work_data[i],na_pattern)
+                    if i in kwargs['num_list']:
+                        work_data[i] = pd.to_numeric(work_data[i] if null_var is None else work_data[i].where(~null_var))
+                    elif null_var is not None:
+                        work_data[i] = work_data[i].where(~null_var,'')
+                work_data.type_num([i for i in kwargs['num_list'] if not pd.api.types.is_numeric_dtype(work_data[i])])
+            elif name == 'type_num':
+                work_data.type_num(kwargs['var_list'])
+            elif name == 'set_category':
+                work_data[kwargs['col_name']] = work_data.set_category()
+            elif name == 'check_outlier':
+                result_list.append((name,work_data.check_outlier(**kwargs)))
+            elif name == 'check_missing':
+                result_list.append((name,work_data.check_missing(**kwargs)))
+            elif name == 'select':
+                work_data = mortgage_pd(pd.DataFrame({i:work_data[i] for i in kwargs['var_list']},copy=False))
+        return work_data,result_list
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import functools
+import tracemalloc
+
+
+"""
+Opt-in instrumentation of the mortgage_pd and mortgage_data methods. Once enabled, every call of a method decorated
+with profile produces an event (a dictionary) with:
+    method: class and method name
+    start: start time (seconds since the epoch)
+    wall, cpu: wall time and CPU time of the call in seconds
+    peak_mb: peak memory allocated during the call above the memory at its start, in MB (None if flag_memory=False)
+    rows, columns: shape of the data (merge_data, or ind_data, for mortgage_data)
+    var_count: number of columns processed (length of var_list when given)
+    groups: number of groups of category, by or key_list when given
+    depth: 0 for a call made by the user, 1 or more for calls made by another instrumented method
+    pid: process id
+Events are passed to a callback, written to a JSON-lines file and kept for summary. When disabled, a decorated
+method only checks one flag before running.
+    import my_profiler
+    my_profiler.enable(jsonl_path='qa_events.jsonl')
+    my_data.check_outlier(['family_income'],category=['State_County'])
+    my_profiler.summary()
+    my_profiler.disable()
+"""
+_state = {'enabled':False,'callback':None,'jsonl':None,'flag_memory':False,'flag_keep':True,'event_list':[],'stack':[]}
+#arguments counted as processed columns, and as groups
+VAR_ARGS = ['var_list','x_list']
+GROUP_ARGS = ['category','by','key_list']
+
+
+"""
+Start recording events.
+IN:
+    callback=None: function called with each event
+    jsonl_path=None: file to which each event is appended as one JSON line
+    flag_memory=False: measure the peak memory of each call with tracemalloc (slows the calls down)
+    flag_keep=True: keep the events in memory for summary
+"""
+def enable(callback=None,jsonl_path=None,flag_memory=False,flag_keep=True):
+    disable()
+    _state['callback'] = callback
+    _state['jsonl'] = open(jsonl_path,'a') if jsonl_path != None else None
+    _state['flag_memory'] = flag_memory
+    _state['flag_keep'] = flag_keep
+    _state['event_list'] = []
+    _state['stack'] = []
+    if flag_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _state['flag_trace_started'] = True
+    _state['enabled'] = True
+
+
+"""
+Stop recording events. The events kept in memory are still available to summary.
+"""
+def disable():
+    _state['enabled'] = False
+    if _state['jsonl'] != None:
+        _state['jsonl'].close()
+        _state['jsonl'] = None
+    if _state.pop('flag_trace_started',False):
+        tracemalloc.stop()
+
+
+"""
+Events kept in memory since the last enable.
+OUT:
+    list of event dictionaries
+"""
+def events():
+    return list(_state['event_list'])
+
+
+"""
+Shape of the data of a mortgage_pd or mortgage_data object, and number of groups of the grouping arguments.
+"""
+def _data_info(obj,kwargs):
+    data = obj if hasattr(obj,'shape') else getattr(obj,'merge_data',getattr(obj,'ind_data',None))
+    info = {'rows':None,'columns':None,'var_count':None,'groups':None}
+    if data is not None and hasattr(data,'shape'):
+        info['rows'],info['columns'] = data.shape
+    for i in VAR_ARGS:
+        if isinstance(kwargs.get(i),(list,tuple)):
+            info['var_count'] = len(kwargs[i])
+    for i in GROUP_ARGS:
+        group = kwargs.get(i)
+        if group != None and data is not None and hasattr(data,'groupby'):
+            try:
+                info['groups'] = data.groupby(group,observed=True).ngroups
+            except (KeyError,ValueError,TypeError):
+                pass
+            break
+    return info
+
+
+"""
+Decorator of the instrumented methods. See the module description.
+"""
+def profile(func):
+    @functools.wraps(func)
+    def wrapper(self,*args,**kwargs):
+        if not _state['enabled']:
+            return func(self,*args,**kwargs)
+        flag_memory = _state['flag_memory'] and tracemalloc.is_tracing()
+        frame = {'peak':0}
+        if flag_memory:
+            current,peak = tracemalloc.get_traced_memory()
+            if _state['stack']:
+                _state['stack'][-1]['peak'] = max(_state['stack'][-1]['peak'],peak)
+            tracemalloc.reset_peak()
+            frame['start_mem'] = current
+        _state['stack'].append(frame)
+        start,wall,cpu = time.time(),time.perf_counter(),time.process_time()
+        try:
+            return func(self,*args,**kwargs)
+        finally:
+            wall,cpu = time.perf_counter()-wall,time.process_time()-cpu
+            _state['stack'].pop()
+            peak_mb = None
+            if flag_memory:
+                peak = max(frame['peak'],tracemalloc.get_traced_memory()[1])
+                if _state['stack']:
+                    _state['stack'][-1]['peak'] = max(_state['stack'][-1]['peak'],peak)
+                peak_mb = (peak-frame['start_mem'])/2**20
+            arg_dict = dict(zip(func.__code__.co_varnames[1:func.__code__.co_argcount],args),**kwargs)
+            event = {'method':func.__qualname__,'start':start,'wall':wall,'cpu':cpu,'peak_mb':peak_mb,
+                     'depth':len(_state['stack']),'pid':os.getpid()}
+            event.update(_data_info(self,arg_dict))
+            _record(event)
+    return wrapper
+
+
+"""
+Pass an event to the callback, the JSON-lines file and the in-memory list.
+"""
+def _record(event):
+    if _state['callback'] != None:
+        _state['callback'](event)
+    if _state['jsonl'] != None:
+        _state['jsonl'].write(json.dumps(event,default=str)+'\n')
+        _state['jsonl'].flush()
+    if _state['flag_keep']:
+        _state['event_list'].append(event)
+
+
+"""
+Summary of the recorded events by method, slowest first.
+IN:
+    event_list=None: list of events (e.g. read back from a JSON-lines file). Events kept in memory by default
+    flag_nested=False: include the calls made by other instrumented methods if True
+    print_flag=True: display the table if True
+OUT:
+    out_data: pd.DataFrame indexed by method with the number of calls, total and mean wall time, total CPU time,
+              largest peak memory and largest number of rows
+"""
+def summary(event_list=None,flag_nested=False,print_flag=True):
+    import pandas as pd
+    if event_list == None:
+        event_list = _state['event_list']
+    event_data = pd.DataFrame(event_list,columns=['method','wall','cpu','peak_mb','rows','depth'])
+    if not flag_nested:
+        event_data = event_data[event_data['depth'] == 0]
+    event_data['peak_mb'] = event_data['peak_mb'].astype(float)
+    event_data['rows'] = event_data['rows'].astype(float)
+    out_data = event_data.groupby('method').agg(**{'Calls':('wall','size'),'Wall':('wall','sum'),'Mean Wall':('wall','mean'),
+                                                   'CPU':('cpu','sum'),'Peak MB':('peak_mb','max'),'Rows':('rows','max')})
+    out_data = out_data.sort_values('Wall',ascending=False)
+    if print_flag:
+        from tabulate import tabulate
+        print(tabulate(out_data.reset_index(),headers='keys',showindex=False,floatfmt=['','','.4g','.4g','.4g','.4g','.0f']))
+    return out_data
+
+
+"""
+Read the events of a JSON-lines file written by enable(jsonl_path=...).
+IN:
+    jsonl_path: path of the file
+OUT:
+    list of event dictionaries
+"""
+def read_events(jsonl_path):
+    with open(jsonl_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import math
+import numpy as np
+import pandas as pd
+
+
+"""
+Linear regression with high-dimensional fixed effects (e.g. State_County, Year_Mortgage, Employer_ID).
+Fixed effects are never expanded into dense dummy columns. They are kept as integer group codes, which are either
+turned into a scipy.sparse design matrix solved by sparse least squares (method='lsqr'), or swept out of the variables
+by iterative demeaning (method='demean', no scipy needed). Standard errors (optionally clustered) are computed from
+the demeaned regressors, so the memory stays proportional to rows times regressors.
+"""
+class sparse_reg(object):
+
+    """
+    Initialization: select the complete rows and encode the fixed effects and clusters.
+    IN:
+        data: DataFrame
+        y: string. Dependent variable
+        x_list: list of strings. Regressors
+        fe_list=[]: list of strings. Columns of fixed effects
+        cluster=None: string. Column of clusters for clustered standard errors
+    """
+    def __init__(self,data,y,x_list,fe_list=[],cluster=None):
+        self.y_name = y
+        self.x_list = list(x_list)
+        self.fe_list = list(fe_list)
+        self.cluster = cluster
+        col_list = [y]+self.x_list
+        flag_valid = data[col_list].notnull().all(axis=1).to_numpy()
+        code_list = []
+        for i in self.fe_list+([cluster] if cluster != None else []):
+            code = pd.factorize(data[i])[0]
+            flag_valid &= code >= 0
+            code_list.append(code)
+        self.y = data[y].to_numpy(dtype=float)[flag_valid]
+        self.x = data[self.x_list].to_numpy(dtype=float)[flag_valid]
+        #re-encode on the complete rows, so codes are 0..levels-1
+        code_list = [pd.factorize(code[flag_valid])[0] for code in code_list]
+        self.cluster_code = code_list.pop() if cluster != None else None
+        self.fe_code = code_list
+        self.nobs = len(self.y)
+
+
+    """
+    Sweep the fixed effects out of the columns of a matrix by alternating projections: subtract the group means
+    of each fixed effect in turn until the largest change is below tol. Without fixed effects, subtract the mean.
+    IN:
+        mat: 2-D np.array (rows, columns)
+        tol=1e-8: convergence tolerance
+        max_iter=1000: maximum number of sweeps
+    OUT:
+        np.array of the demeaned columns
+    """
+    def demean(self,mat,tol=1e-8,max_iter=1000):
+        mat = np.array(mat,dtype=float)
+        if len(self.fe_code) == 0:
+            return mat-mat.mean(axis=0)
+        count_list = [np.bincount(code) for code in self.fe_code]
+        for _ in range(max_iter):
+            change = 0
+            for code,count in zip(self.fe_code,count_list):
+                for j in range(mat.shape[1]):
+                    group_mean = np.bincount(code,weights=mat[:,j])/count
+                    mat[:,j] -= group_mean[code]
+                    change = max(change,np.abs(group_mean).max())
+            if change < tol or len(self.fe_code) == 1:
+                break
+        return mat
+
+
+    """
+    Sparse design matrix [x, fixed effect dummies]. The first fixed effect keeps all its levels (it absorbs the intercept),
+    the others drop their first level. An intercept column is added if there is no fixed effect.
+    OUT:
+        scipy.sparse.csr_matrix
+    """
+    def design(self):
+        from scipy import sparse
+        block_list = [sparse.csr_matrix(self.x)]
+        if len(self.fe_code) == 0:
+            block_list.append(sparse.csr_matrix(np.ones((self.nobs,1))))
+        for k,code in enumerate(self.fe_code):
+            dummy = sparse.csr_matrix((np.ones(self.nobs),(np.arange(self.nobs),code)),shape=(self.nobs,code.max()+1))
+            block_list.append(dummy if k == 0 else dummy[:,1:])
+        return sparse.hstack(block_list,format='csr')
+
+
+    """
+    Estimate the coefficients of x_list and their standard errors.
+    IN:
+        method='demean': 'demean' (iterative demeaning) or 'lsqr' (sparse least squares on the design matrix)
+        robust=False: heteroskedasticity-robust standard errors if True (ignored when clustering)
+        tol=1e-8: tolerance of demeaning and lsqr
+        max_iter=1000: maximum number of demeaning sweeps
+    OUT:
+        out_data: pd.DataFrame indexed by x_list, with columns Coef, Std. Err., t and P>|t| (normal approximation)
+    """
+    def fit(self,method='demean',robust=False,tol=1e-8,max_iter=1000):
+        x_tilde = self.demean(self.x,tol,max_iter)
+        if method == 'demean':
+            y_tilde = self.demean(self.y.reshape(-1,1),tol,max_iter)[:,0]
+            coef = np.linalg.lstsq(x_tilde,y_tilde,rcond=None)[0]
+            resid = y_tilde-x_tilde@coef
+        elif method == 'lsqr':
+            from scipy.sparse.linalg import lsqr
+            design = self.design()
+            full_coef = lsqr(design,self.y,atol=tol,btol=tol)[0]
+            coef = full_coef[:len(self.x_list)]
+            resid = self.y-design@full_coef
+        else:
+            raise NameError('Wrong Method')
+        num_x = len(self.x_list)
+        num_absorbed = sum(code.max()+1 for code in self.fe_code)-max(len(self.fe_code)-1,0) if self.fe_code else 1
+        dof = self.nobs-num_x-num_absorbed
+        bread = np.linalg.inv(x_tilde.T@x_tilde)
+        if self.cluster_code is not None:
+            num_cluster = self.cluster_code.max()+1
+            score = np.stack([np.bincount(self.cluster_code,weights=x_tilde[:,j]*resid,minlength=num_cluster) \
+                              for j in range(num_x)],axis=1)
+            scale = num_cluster/(num_cluster-1)*(self.nobs-1)/dof
+            cov = scale*bread@(score.T@score)@bread
+        elif robust:
+            score = x_tilde*resid.reshape(-1,1)
+            cov = self.nobs/dof*bread@(score.T@score)@bread
+        else:
+            cov = resid@resid/dof*bread
+        std_err = np.sqrt(np.diag(cov))
+        t_stat = coef/std_err
+        p_value = [math.erfc(abs(t)/math.sqrt(2)) for t in t_stat]
+        self.resid = resid
+        return pd.DataFrame({'Coef':coef,'Std. Err.':std_err,'t':t_stat,'P>|t|':p_value},index=pd.Index(self.x_list,name='Columns'))
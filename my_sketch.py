@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+import math
+import numpy as np
+import pandas as pd
+
+
+"""
+Mergeable quantile sketch (KLL type). Values are kept in levels of compactors: the items of level h stand for
+2**h values. When a level exceeds its capacity it is sorted and every other item (random offset) is promoted
+to the next level. The normalized rank error is about eps, using O(1/eps) memory whatever the number of values.
+Sketches built on different chunks (or in different processes) can be merged.
+While no compaction has happened the sketch holds the values themselves, and quantiles are exact.
+"""
+class kll_sketch(object):
+
+    """
+    Initialization
+    IN:
+        eps=0.001: target normalized rank error
+        rng=None: np.random.Generator used for the compactions
+    """
+    def __init__(self,eps=0.001,rng=None):
+        self.k = max(8,int(math.ceil(1.65/eps)))
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.level_list = [np.empty(0)]
+        self.n = 0
+
+
+    """
+    Capacity of a level: k for the top level, shrinking by 2/3 for each level below.
+    """
+    def capacity(self,h):
+        return max(2,int(math.ceil(self.k*(2.0/3)**(len(self.level_list)-1-h))))
+
+
+    """
+    Add values to the sketch. Missing values are skipped.
+    IN:
+        values: np.array or pd.Series of numbers
+    """
+    def update(self,values):
+        values = np.asarray(values,dtype=float)
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        self.level_list[0] = np.concatenate([self.level_list[0],values])
+        self.compress()
+
+
+    """
+    Merge another sketch into this one.
+    IN:
+        other: kll_sketch
+    """
+    def merge(self,other):
+        while len(self.level_list) < len(other.level_list):
+            self.level_list.append(np.empty(0))
+        for h,level in enumerate(other.level_list):
+            self.level_list[h] = np.concatenate([self.level_list[h],level])
+        self.n += other.n
+        self.compress()
+
+
+    """
+    Compact the levels over capacity, lowest level first.
+    """
+    def compress(self):
+        h = 0
+        while h < len(self.level_list):
+            level = self.level_list[h]
+            if len(level) > self.capacity(h):
+                if h+1 == len(self.level_list):
+                    self.level_list.append(np.empty(0))
+                level = np.sort(level)
+                keep = level[-1:] if len(level)%2 else level[0:0] #odd item stays at this level
+                pair = level[:len(level)-len(keep)]
+                self.level_list[h] = keep
+                self.level_list[h+1] = np.concatenate([self.level_list[h+1],pair[self.rng.integers(2)::2]])
+            else:
+                h += 1
+
+
+    """
+    Approximate quantiles (exact, with linear interpolation, while no compaction has happened).
+    IN:
+        q_list: list of quantiles between 0 and 1
+        center=None: if given, quantiles of the absolute deviations from center (e.g. the median absolute deviation).
+                     The kept items stand for the values, so the rank error is at most about twice eps
+    OUT:
+        np.array of the quantiles, np.nan if the sketch is empty
+    """
+    def quantile(self,q_list,center=None):
+        q_list = np.asarray(q_list,dtype=float)
+        if self.n == 0:
+            return np.full(len(q_list),np.nan)
+        transform = (lambda x: x) if center == None else (lambda x: np.abs(x-center))
+        if len(self.level_list) == 1:
+            return np.quantile(transform(self.level_list[0]),q_list)
+        value = transform(np.concatenate(self.level_list))
+        weight = np.concatenate([np.full(len(level),2.0**h) for h,level in enumerate(self.level_list)])
+        order = np.argsort(value,kind='stable')
+        value,weight = value[order],np.cumsum(weight[order])
+        pos = np.searchsorted(weight,q_list*weight[-1],side='left')
+        return value[np.minimum(pos,len(value)-1)]
+
+
+"""
+Mergeable count, mean, standard deviation, minimum and maximum of numeric columns. Chunks are summarized with numpy
+and combined with the pairwise update of Chan et al., so the moments of appended data never require the old rows.
+"""
+class running_moments(object):
+
+    """
+    Initialization
+    IN:
+        var_list: list of strings. Numeric columns
+    """
+    def __init__(self,var_list):
+        self.var_list = list(var_list)
+        self.count = np.zeros(len(var_list))
+        self.mean = np.zeros(len(var_list))
+        self.m2 = np.zeros(len(var_list))
+        self.min = np.full(len(var_list),np.nan)
+        self.max = np.full(len(var_list),np.nan)
+
+
+    """
+    Add the rows of a DataFrame. Missing values are skipped.
+    IN:
+        data: DataFrame with the columns of var_list
+    """
+    def update(self,data):
+        block = data[self.var_list].to_numpy(dtype=float).reshape(-1,len(self.var_list))
+        count = np.sum(~np.isnan(block),axis=0).astype(float)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean = np.nansum(block,axis=0)/count
+            m2 = np.nansum((block-mean)**2,axis=0)
+        flag_new = count > 0
+        total = self.count+count
+        delta = np.where(flag_new,mean-self.mean,0)
+        weight = np.divide(count,total,out=np.zeros_like(total),where=total>0)
+        self.m2 = self.m2+np.where(flag_new,m2,0)+delta**2*self.count*weight
+        self.mean = self.mean+delta*weight
+        self.count = total
+        if len(block) > 0:
+            self.min = np.fmin(self.min,np.fmin.reduce(block,axis=0))
+            self.max = np.fmax(self.max,np.fmax.reduce(block,axis=0))
+
+
+    """
+    Current statistics.
+    OUT:
+        pd.DataFrame indexed by var_list with columns Count, Mean, Std., Min and Max (same as mortgage_pd.sum_stats)
+    """
+    def stats(self):
+        with np.errstate(invalid='ignore',divide='ignore'):
+            std = np.sqrt(self.m2/(self.count-1))
+        flag_count = self.count > 0
+        return pd.DataFrame({'Count':self.count,'Mean':np.where(flag_count,self.mean,np.nan),'Std.':std,
+                             'Min':self.min,'Max':self.max},index=pd.Index(self.var_list,name='Columns'))
+
+
+"""
+Group keys of the rows of a chunk, matching the index of the statistics built by sketch_MAD.
+"""
+def _group_key(chunk,category):
+    if category == None:
+        return pd.Index(np.zeros(len(chunk),dtype=int))
+    if len(category) == 1:
+        return pd.Index(chunk[category[0]])
+    return pd.MultiIndex.from_frame(chunk[category])
+
+
+"""
+Update the sketches of a dictionary group key -> kll_sketch with values aligned with group keys.
+"""
+def _update_sketch(sketch_dict,values,key,eps,rng):
+    values = pd.Series(values,index=key)
+    level = 0 if key.nlevels == 1 else list(range(key.nlevels))
+    for group,group_values in values.groupby(level=level,sort=False,observed=True):
+        if group not in sketch_dict:
+            sketch_dict[group] = kll_sketch(eps,rng)
+        sketch_dict[group].update(group_values.to_numpy())
+
+
+"""
+Quantiles of each sketch of a dictionary group key -> kll_sketch.
+OUT:
+    pd.DataFrame indexed by group key with one column per name in name_list
+"""
+def _group_quantile(sketch_dict,q_list,name_list,category):
+    key_list = list(sketch_dict)
+    if category != None and len(category) > 1:
+        index = pd.MultiIndex.from_tuples(key_list,names=category)
+    else:
+        index = pd.Index(key_list,name=None if category == None else category[0])
+    value = [sketch_dict[key].quantile(q_list) for key in key_list]
+    return pd.DataFrame(np.array(value).reshape(len(key_list),len(q_list)),index=index,columns=name_list)
+
+
+"""
+Sketches of numeric columns group by group, updated as rows are appended (e.g. one PSID wave at a time).
+Since the deviations from the median are taken from the kept items (see kll_sketch.quantile), the outlier statistics
+need a single pass and stay up to date without reading the old rows again. They are less accurate than sketch_MAD,
+which sketches the deviations in a second pass.
+"""
+class group_sketch(object):
+
+    """
+    Initialization
+    IN:
+        var_list: list of strings. Numeric columns
+        category=None: list of strings. Columns of the groups
+        eps=0.001: target normalized rank error of the sketches
+        seed=None: seed of the random compactions
+    """
+    def __init__(self,var_list,category=None,eps=0.001,seed=None):
+        self.var_list = list(var_list)
+        self.category = [category] if isinstance(category,str) else category
+        self.eps = eps
+        self.rng = np.random.default_rng(seed)
+        self.sketch_dict = {i:dict() for i in self.var_list}
+
+
+    """
+    Add the rows of a DataFrame.
+    IN:
+        data: DataFrame with the columns of var_list and category
+    """
+    def update(self,data):
+        for i in self.var_list:
+            _update_sketch(self.sketch_dict[i],data[i].to_numpy(dtype=float),_group_key(data,self.category),self.eps,self.rng)
+
+
+    """
+    Current outlier statistics.
+    OUT:
+        stats_dict: dictionary. column name -> pd.DataFrame indexed by group with columns med, mad and cut_off,
+                    see sketch_MAD and sketch_flag
+    """
+    def stats(self):
+        stats_dict = dict()
+        for i in self.var_list:
+            med = _group_quantile(self.sketch_dict[i],[0.5],['med'],self.category)['med']
+            dev = [self.sketch_dict[i][key].quantile([0.5,0.99],center=med.iloc[k]) for k,key in enumerate(self.sketch_dict[i])]
+            dev_stats = pd.DataFrame(np.array(dev).reshape(-1,2),index=med.index,columns=['mad','cut_off'])
+            stats_dict[i] = pd.concat([med,dev_stats],axis=1)
+        return stats_dict
+
+
+"""
+Streaming version of the statistics of mortgage_pd.MAD, for data read chunk by chunk (e.g. mortgage_data.stream_csv).
+The data is read twice whatever the number of columns: the first pass sketches all columns by group to get the
+medians, the second pass sketches the absolute deviations from the medians to get the median absolute deviation and
+the 99th percentile of the deviations (the score cutoff of MAD times the median absolute deviation).
+IN:
+    chunk_func: function without arguments returning a new iterator of DataFrame chunks
+    var_list: list of strings. Numeric columns
+    category=None: list of strings. Columns of the groups
+    eps=0.001: target normalized rank error of the sketches
+    seed=None: seed of the random compactions
+OUT:
+    stats_dict: dictionary. column name -> pd.DataFrame indexed by group with columns med, mad and cut_off
+"""
+def sketch_MAD(chunk_func,var_list,category=None,eps=0.001,seed=None):
+    if isinstance(category,str):
+        category = [category]
+    rng = np.random.default_rng(seed)
+    med_sketch = {i:dict() for i in var_list}
+    for chunk in chunk_func():
+        key = _group_key(chunk,category)
+        for i in var_list:
+            _update_sketch(med_sketch[i],chunk[i].to_numpy(dtype=float),key,eps,rng)
+    med_dict = {i:_group_quantile(med_sketch[i],[0.5],['med'],category)['med'] for i in var_list}
+    dev_sketch = {i:dict() for i in var_list}
+    for chunk in chunk_func():
+        key = _group_key(chunk,category)
+        for i in var_list:
+            dev = np.abs(chunk[i].to_numpy(dtype=float)-med_dict[i].reindex(key).to_numpy())
+            _update_sketch(dev_sketch[i],dev,key,eps,rng)
+    stats_dict = dict()
+    for i in var_list:
+        dev_stats = _group_quantile(dev_sketch[i],[0.5,0.99],['mad','cut_off'],category)
+        stats_dict[i] = pd.concat([med_dict[i],dev_stats.reindex(med_dict[i].index)],axis=1)
+    return stats_dict
+
+
+"""
+Flag the outliers of a chunk from the statistics of sketch_MAD, following the rule of mortgage_pd.MAD.
+IN:
+    chunk: DataFrame
+    stats_dict: output of sketch_MAD
+    category=None: list of strings. Columns of the groups
+OUT:
+    flag: pd.DataFrame, takes -1 if outlier, 1 if regular, np.nan if missing
+"""
+def sketch_flag(chunk,stats_dict,category=None):
+    if isinstance(category,str):
+        category = [category]
+    key = _group_key(chunk,category)
+    flag = pd.DataFrame(index=chunk.index)
+    for i in stats_dict:
+        stats = stats_dict[i].reindex(key)
+        dev = np.abs(chunk[i].to_numpy(dtype=float)-stats['med'].to_numpy())
+        flag_score = stats['mad'].to_numpy() > 0.1
+        with np.errstate(invalid='ignore'):
+            cut_off_flag = np.where(flag_score,dev > stats['cut_off'].to_numpy(),dev > 1)
+        flag[i] = np.where(np.isnan(dev),np.nan,np.where(cut_off_flag,-1.0,1.0))
+    return flag
+
+
+"""
+Out-of-core outlier check: build the sketches (two passes), then flag each chunk (third pass).
+IN:
+    chunk_func: function without arguments returning a new iterator of DataFrame chunks
+    var_list: list of strings. Numeric columns
+    category=None: list of strings. Columns of the groups
+    eps=0.001: target normalized rank error of the sketches
+    seed=None: seed of the random compactions
+OUT:
+    generator of the flags of each chunk, see sketch_flag
+"""
+def sketch_outlier(chunk_func,var_list,category=None,eps=0.001,seed=None):
+    stats_dict = sketch_MAD(chunk_func,var_list,category,eps,seed)
+    for chunk in chunk_func():
+        yield sketch_flag(chunk,stats_dict,category)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from my_helper import download_manager
+
+
+CONTENT = bytes(range(256))*400
+
+
+"""
+HTTP handler serving the files of server.file_dict (path -> bytes). Range requests are answered with 206 unless
+server.flag_range is False or their If-Range is not the current ETag, and with 416 when the range starts at the end
+of the file. Requests are logged in server.log as (method, path, Range header, status).
+"""
+class range_handler(BaseHTTPRequestHandler):
+
+    def do_HEAD(self):
+        self.respond(flag_body=False)
+
+    def do_GET(self):
+        self.respond(flag_body=True)
+
+    def respond(self,flag_body):
+        content = self.server.file_dict.get(self.path)
+        range_str = self.headers.get('Range')
+        if content == None:
+            status,body = 404,b''
+        elif range_str != None and self.server.flag_range and flag_body and self.headers.get('If-Range',self.server.etag) == self.server.etag:
+            start = int(range_str.split('=')[1].split('-')[0])
+            status,body = (416,b'') if start >= len(content) else (206,content[start:])
+        else:
+            status,body = 200,content
+        self.server.log.append((self.command,self.path,range_str,status))
+        self.send_response(status)
+        self.send_header('Content-Length',str(len(body) if flag_body else len(content or b'')))
+        if content != None:
+            self.send_header('ETag',self.server.etag)
+        if status == 206:
+            self.send_header('Content-Range','bytes {}-{}/{}'.format(len(content)-len(body),len(content)-1,len(content)))
+        self.end_headers()
+        if flag_body:
+            self.wfile.write(body)
+
+    def log_message(self,*args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1',0),range_handler)
+    server.file_dict = {'/wave.csv':CONTENT}
+    server.flag_range = True
+    server.etag = '"v1"'
+    server.log = []
+    thread = threading.Thread(target=server.serve_forever,daemon=True)
+    thread.start()
+    server.url = 'http://127.0.0.1:{}/wave.csv'.format(server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_requests(server):
+    return [entry for entry in server.log if entry[0] == 'GET']
+
+
+"""
+Partial download of the first bytes of content, with the ETag it was downloaded from.
+"""
+def write_part(tmp_path,content,etag='"v1"'):
+    with open(tmp_path/'wave.csv.part','wb') as f:
+        f.write(content)
+    with open(tmp_path/'wave.csv.part.json','w') as f:
+        json.dump({'etag':etag,'last_modified':None},f)
+
+
+def read_file(path):
+    with open(path,'rb') as f:
+        return f.read()
+
+
+def test_resume_from_part(server,tmp_path):
+    write_part(tmp_path,CONTENT[:1000])
+    manager = download_manager(str(tmp_path))
+    status_dict = manager.fetch([server.url],{server.url:hashlib.sha256(CONTENT).hexdigest()})
+    assert status_dict[server.url] == 'downloaded'
+    assert get_requests(server) == [('GET','/wave.csv','bytes=1000-',206)]
+    assert read_file(tmp_path/'wave.csv') == CONTENT
+    assert not os.path.exists(tmp_path/'wave.csv.part')
+    assert not os.path.exists(tmp_path/'wave.csv.part.json')
+
+
+def test_part_already_complete(server,tmp_path):
+    write_part(tmp_path,CONTENT)
+    manager = download_manager(str(tmp_path))
+    status_dict = manager.fetch([server.url],{server.url:hashlib.sha256(CONTENT).hexdigest()})
+    assert status_dict[server.url] == 'downloaded'
+    assert get_requests(server) == [('GET','/wave.csv','bytes={}-'.format(len(CONTENT)),416)]
+    assert read_file(tmp_path/'wave.csv') == CONTENT
+
+
+def test_range_ignored(server,tmp_path):
+    server.flag_range = False
+    write_part(tmp_path,CONTENT[:1000])
+    manager = download_manager(str(tmp_path))
+    status_dict = manager.fetch([server.url],{server.url:hashlib.sha256(CONTENT).hexdigest()})
+    assert status_dict[server.url] == 'downloaded'
+    assert get_requests(server) == [('GET','/wave.csv','bytes=1000-',200)]
+    assert read_file(tmp_path/'wave.csv') == CONTENT
+
+
+@pytest.mark.parametrize('etag',['"v0"',None])
+def test_part_of_changed_file(server,tmp_path,etag):
+    new_content = b'B'*1000
+    server.file_dict['/wave.csv'] = new_content
+    with open(tmp_path/'wave.csv.part','wb') as f:
+        f.write(b'A'*600)
+    if etag != None: #without a validator file the origin of the partial download is unknown
+        write_part(tmp_path,b'A'*600,etag)
+    manager = download_manager(str(tmp_path))
+    assert manager.fetch([server.url])[server.url] == 'downloaded'
+    assert get_requests(server) == [('GET','/wave.csv',None,200)]
+    assert read_file(tmp_path/'wave.csv') == new_content
+    assert manager.manifest[server.url]['size'] == len(new_content)
+
+
+def test_if_range(server,tmp_path):
+    write_part(tmp_path,CONTENT[:1000])
+    server.log = []
+    #the file changes after the HEAD request: the server answers the range with the whole file
+    manager = download_manager(str(tmp_path))
+    head = manager.head(server.url)
+    server.etag = '"v2"'
+    manager.total_bytes,manager.done_bytes,manager.done_files,manager.total_files = 0,0,0,1
+    assert manager.fetch_one(server.url,str(tmp_path/'wave.csv'),head,None) == 'downloaded'
+    assert get_requests(server) == [('GET','/wave.csv','bytes=1000-',200)]
+    assert read_file(tmp_path/'wave.csv') == CONTENT
+
+
+def test_checksum_mismatch(server,tmp_path):
+    manager = download_manager(str(tmp_path))
+    status_dict = manager.fetch([server.url],{server.url:hashlib.sha256(b'other').hexdigest()})
+    assert status_dict[server.url].startswith('failed: checksum mismatch')
+    assert not os.path.exists(tmp_path/'wave.csv.part')
+    assert not os.path.exists(tmp_path/'wave.csv.part.json')
+    assert not os.path.exists(tmp_path/'wave.csv')
+    assert server.url not in download_manager(str(tmp_path)).manifest
+
+
+def test_manifest_skip_and_etag_change(server,tmp_path):
+    assert download_manager(str(tmp_path)).fetch([server.url])[server.url] == 'downloaded'
+    with open(tmp_path/'download_manifest.json') as f:
+        entry = json.load(f)[server.url]
+    assert entry['etag'] == '"v1"' and entry['size'] == len(CONTENT)
+    #new manager: the manifest is read back from the download directory
+    assert download_manager(str(tmp_path)).fetch([server.url])[server.url] == 'skipped'
+    assert len(get_requests(server)) == 1
+    server.etag = '"v2"'
+    server.file_dict['/wave.csv'] = CONTENT[::-1]
+    assert download_manager(str(tmp_path)).fetch([server.url])[server.url] == 'downloaded'
+    assert len(get_requests(server)) == 2
+    assert read_file(tmp_path/'wave.csv') == CONTENT[::-1]
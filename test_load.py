@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+
+import pytest
+
+from my_PSID_class import mortgage_data
+
+
+"""
+PSID files in a temporary working directory. Family_ID is numeric in the first rows only, so chunks of 2 rows
+see a numeric id column in some chunks and a string one in others. 5 rows are not divided evenly by the chunk size.
+"""
+@pytest.fixture
+def psid_dir(tmp_path,monkeypatch):
+    pd.DataFrame({'Year_Mortgage':[1990]*5,'Family_ID':['1','3','2','A4','5'],'SSN_deidentified':[1,2,3,4,5],
+                  'State':['NY','NY','CA','CA','NA'],'mortgage_in_thousands':['10','20','NA','40','50']}) \
+        .to_csv(tmp_path/'PSID_1968_2013_Individual.csv',index=False)
+    pd.DataFrame({'Year_Mortgage':[1990]*5,'Family_ID':['A4','3','2','1','5'],'SSN_deidentified':[4,2,3,1,5],
+                  'family_income':['50','60','70','n/a','90'],'Number_of_People':[1,2,3,4,5],
+                  'Total_Family_Debt':[0,1,0,1,0],'Welfare_Receipt':[0,0,1,1,0]}) \
+        .to_csv(tmp_path/'PSID_1968_2013_family.csv',index=False)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def merged(data):
+    data.mortgage_init()
+    return pd.DataFrame(data.merge_data).astype(str)
+
+
+def test_chunked_matches_whole_file(psid_dir):
+    expected = merged(mortgage_data())
+    for chunksize in [2,3]:
+        data = mortgage_data(chunksize=chunksize)
+        assert data.ind_data['Family_ID'].map(type).nunique() == 1
+        pd.testing.assert_frame_equal(merged(data),expected)
+    assert (expected['family_income'] != 'nan').sum() == 4
+
+
+def test_chunked_cache(psid_dir):
+    expected = merged(mortgage_data(chunksize=2))
+    merged(mortgage_data(chunksize=2,cache_dir='cache'))
+    pd.testing.assert_frame_equal(merged(mortgage_data(chunksize=2,cache_dir='cache')),expected)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+import pytest
+
+from my_PSID_class import mortgage_pd
+from my_sketch import sketch_outlier
+
+
+"""
+Data with a wide column (mad>0.1 in every group), a column constant within most groups (mad<=0.1, with a few
+deviations), missing values, and categories with missing entries.
+"""
+@pytest.fixture(scope='module')
+def data():
+    rng = np.random.default_rng(0)
+    n = 3000
+    wide = rng.lognormal(3,1,n)
+    wide[rng.random(n) < 0.05] = np.nan
+    flat = np.full(n,2.0)
+    flat[rng.choice(n,60,replace=False)] = rng.normal(0,5,60)
+    flat[rng.random(n) < 0.05] = np.nan
+    county = rng.choice(['A','B','C','D',None],n,p=[0.3,0.3,0.2,0.15,0.05])
+    state = rng.choice([1,2],n).astype(float)
+    state[rng.random(n) < 0.02] = np.nan
+    return mortgage_pd({'wide':wide,'flat':flat,'county':county,'state':state},index=np.arange(n)*2)
+
+
+"""
+Outliers of the per-group transform(MAD) that check_outlier used before it was vectorized.
+"""
+def baseline(data,var_list,category):
+    out_dict = dict()
+    for i in var_list:
+        flag = data.groupby(category)[i].transform(lambda col: mortgage_pd.MAD(col))
+        out_dict[i+'_MAD'] = data.index[flag==-1]
+    return out_dict
+
+
+@pytest.mark.parametrize('category',[['county'],['county','state']])
+@pytest.mark.parametrize('n_jobs',[None,2])
+def test_category_matches_transform(data,category,n_jobs):
+    var_list = ['wide','flat']
+    expected = baseline(data,var_list,category)
+    out_dict = data.check_outlier(var_list,category=category,n_jobs=n_jobs)
+    assert list(out_dict) == list(expected)
+    for key in expected:
+        assert len(expected[key]) > 0
+        assert out_dict[key].equals(expected[key])
+
+
+@pytest.mark.parametrize('n_jobs',[None,2])
+def test_flat_column_uses_absolute_rule(data,n_jobs):
+    dev = (data['flat']-data.groupby('county')['flat'].transform('median')).abs()
+    assert (dev.groupby(data['county']).median() <= 0.1).all()
+    out_dict = data.check_outlier(['flat'],category=['county'],n_jobs=n_jobs)
+    assert out_dict['flat_MAD'].equals(data.index[dev > 1])
+
+
+def test_sketch_passes_and_seed(data):
+    var_list = ['wide','flat']
+    call_list = []
+    def chunk_func():
+        call_list.append(1)
+        return (data.iloc[i:i+700] for i in range(0,len(data),700))
+    flag_list = list(sketch_outlier(chunk_func,var_list,['county'],eps=0.01,seed=0))
+    #two passes for the sketches of all columns, one for the flags
+    assert len(call_list) == 3
+    assert sum(len(flag) for flag in flag_list) == len(data)
+    out_list = [data.check_outlier(var_list,method='sketch',category=['county'],eps=0.01,chunksize=700) for _ in range(2)]
+    for key in out_list[0]:
+        assert out_list[0][key].equals(out_list[1][key])